@@ -30,3 +30,16 @@ class ComplaintAdmin(admin.ModelAdmin):
     )
 
 admin.site.register(Complaint, ComplaintAdmin)
+
+
+class SourceFileAdmin(admin.ModelAdmin):
+    list_display = ('name', 'row_count', 'sha1', 'loaded')
+
+admin.site.register(SourceFile, SourceFileAdmin)
+
+
+class ComplaintSummaryAdmin(admin.ModelAdmin):
+    list_display = ('region', 'priority', 'is_closed', 'total', 'gt_30_days', 'gt_90_days', 'gt_180_days', 'more_than_one_year', 'median_wait_kmf')
+    list_filter = ['region', 'priority', 'is_closed']
+
+admin.site.register(ComplaintSummary, ComplaintSummaryAdmin)
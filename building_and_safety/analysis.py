@@ -0,0 +1,246 @@
+"""
+Number crunching shared by the analysis views and the commands that precompute them.
+"""
+from django.db import connection, transaction
+from django.db.models import Count, Max, Min
+from building_and_safety.models import Complaint, ComplaintSummary, ComplaintTypeSummary, SurvivalHistogram, REGION_NAMES
+from building_and_safety.survival import fit_complaint_strata, get_stored_histograms, PRIORITIES
+from building_and_safety.caching import bump_data_version
+from building_and_safety.publish import publish
+
+# The age flags we count on every summary row
+AGE_FIELDS = ('gt_30_days', 'gt_90_days', 'gt_180_days', 'more_than_one_year')
+
+# The flags we break counts down by, along with open/closed status and priority
+COUNT_FIELDS = ('resolved_apc', 'csr_priority', 'is_closed') + AGE_FIELDS
+
+
+def get_complaints_per_year():
+    """
+    Complaints filed in each region in each year, for every region in one grouped query.
+
+    The average per year divides by the span the data actually covers,
+    from the first complaint received to the last, rather than a hard-coded number of years.
+    """
+    qs = Complaint.objects.filter(resolved_apc__in=REGION_NAMES, days_since_complaint__gte=0)
+    span = qs.aggregate(first=Min('date_received'), last=Max('date_received'))
+    counts = qs.extra(select={'year':"date_part('year',date_received)"})\
+        .values('resolved_apc', 'year').annotate(count=Count('id')).order_by()
+
+    span_years = None
+    if span['first'] and span['last']:
+        span_years = (span['last'] - span['first']).days / 365.0
+
+    regions = dict((region, {'years': {}, 'total': 0, 'avg_per_year': None}) for region in REGION_NAMES)
+    for row in counts:
+        region = regions[row['resolved_apc']]
+        region['years'][int(row['year'])] = row['count']
+        region['total'] += row['count']
+
+    for region in regions.values():
+        if span_years:
+            region['avg_per_year'] = region['total'] / span_years
+
+    return {
+        'first_received': span['first'],
+        'last_received': span['last'],
+        'span_years': span_years,
+        'regions': regions,
+    }
+
+
+class ComplaintCounts(object):
+    """
+    Counts of complaints grouped by region, priority, open/closed status and age,
+    all from a single GROUP BY query.
+
+    Any combination of those fields can then be counted in Python
+    without going back to the database, so the number of queries
+    doesn't grow as we add regions or breakdowns.
+    """
+    def __init__(self, queryset=None):
+        if queryset is None:
+            queryset = Complaint.objects.all()
+        # The per-region numbers leave out complaints with bad dates,
+        # so flag those in the same pass. Clearing the ordering keeps
+        # date_received out of the GROUP BY.
+        qs = queryset.extra(select={'valid_days': 'days_since_complaint >= 0'})\
+            .values('valid_days', *COUNT_FIELDS).annotate(count=Count('id')).order_by()
+        self.groups = list(qs)
+
+    def count(self, **filters):
+        """
+        How many complaints match all the given field values.
+        Pass valid_days=True to only count complaints with a sensible days_since_complaint.
+        """
+        items = filters.items()
+        return sum(
+            group['count'] for group in self.groups
+            if all(group[field] == value for field, value in items)
+        )
+
+    def by_csr(self, **filters):
+        """
+        Counts of the matching complaints at each CSR priority level.
+        """
+        counts = {}
+        for priority in ('1', '2', '3'):
+            counts["csr%s" % priority] = self.count(csr_priority=priority, **filters)
+        return counts
+
+
+def build_summaries():
+    """
+    Compute a ComplaintSummary for every combination of region, priority and
+    open/closed status, straight from the complaints table. Nothing is saved.
+    """
+    counts = ComplaintCounts()
+    per_year = get_complaints_per_year()
+    # Fit the survival curves from the stored histograms if we have them
+    strata = fit_complaint_strata(histograms=get_stored_histograms() or None)
+    summaries = []
+    for region in [None] + list(REGION_NAMES):
+        region_filter = {}
+        if region:
+            region_filter = {'resolved_apc': region, 'valid_days': True}
+        for priority in [None] + list(PRIORITIES):
+            priority_filter = dict(region_filter)
+            if priority:
+                priority_filter['csr_priority'] = priority
+            for is_closed in (None, False, True):
+                filters = dict(priority_filter)
+                if is_closed is not None:
+                    filters['is_closed'] = is_closed
+                summary = ComplaintSummary(
+                    region=region or '',
+                    priority=priority or '',
+                    is_closed=is_closed,
+                    total=counts.count(**filters),
+                )
+                for field in AGE_FIELDS:
+                    setattr(summary, field, counts.count(**dict(filters, **{field: True})))
+                if is_closed is None:
+                    summary.median_wait_kmf = strata[(region, priority)].median_
+                    if region and not priority:
+                        summary.complaints_per_year = per_year['regions'][region]['avg_per_year']
+                summaries.append(summary)
+    return summaries
+
+
+def build_type_summaries():
+    """
+    Count each type of complaint in each region and priority level with one grouped query.
+    Only the named APCs get counted, the same regions every other breakdown covers.
+    """
+    qs = Complaint.objects.filter(resolved_apc__in=REGION_NAMES)\
+        .values('resolved_apc', 'csr_priority', 'csr_problem_type')\
+        .annotate(count=Count('id')).order_by()
+
+    totals = {}
+    for row in qs:
+        region, problem_type = row['resolved_apc'], row['csr_problem_type']
+        for priority in (row['csr_priority'] or '', ''):
+            key = (region, priority, problem_type)
+            totals[key] = totals.get(key, 0) + row['count']
+            if not row['csr_priority']:
+                break
+    return [
+        ComplaintTypeSummary(region=key[0], priority=key[1], csr_problem_type=key[2], count=count)
+        for key, count in totals.items()
+    ]
+
+
+def refresh_summaries():
+    """
+    Rebuild the precomputed summary tables in one transaction,
+    so readers never see them half filled.
+    """
+    summaries = build_summaries()
+    type_summaries = build_type_summaries()
+    with transaction.atomic():
+        ComplaintSummary.objects.all().delete()
+        ComplaintSummary.objects.bulk_create(summaries)
+        ComplaintTypeSummary.objects.all().delete()
+        ComplaintTypeSummary.objects.bulk_create(type_summaries, batch_size=500)
+    return len(summaries), len(type_summaries)
+
+
+def get_summaries():
+    """
+    The summary rows keyed by (region, priority, is_closed), with blanks meaning "all".
+    If the table hasn't been filled yet, they're computed on the spot.
+    """
+    summaries = list(ComplaintSummary.objects.all())
+    if not summaries:
+        summaries = build_summaries()
+    return dict(((s.region, s.priority, s.is_closed), s) for s in summaries)
+
+
+def get_top_types(n=10, priority='', start=None, end=None):
+    """
+    The n most common types of complaint in each of the named regions, as a dict of region
+    to a list of {'csr_problem_type': ..., 'count': ...} dicts, most common first.
+
+    Optionally count only one priority level, or complaints received between
+    the start and end dates. Without a date range the counts come from the
+    precomputed rollup. With one, a single query ranks the types inside each region.
+    """
+    top = dict((region, []) for region in REGION_NAMES)
+    if start is None and end is None:
+        rows = ComplaintTypeSummary.objects.filter(priority=priority)\
+            .order_by('region', '-count', 'csr_problem_type')\
+            .values_list('region', 'csr_problem_type', 'count')
+        if rows.exists():
+            for region, problem_type, count in rows:
+                types = top.get(region)
+                if types is not None and len(types) < n:
+                    types.append({'csr_problem_type': problem_type, 'count': count})
+            return top
+
+    qn = connection.ops.quote_name
+    where, params = ["resolved_apc IN %s"], [tuple(REGION_NAMES)]
+    if priority:
+        where.append("csr_priority = %s")
+        params.append(priority)
+    if start is not None:
+        where.append("date_received >= %s")
+        params.append(start)
+    if end is not None:
+        where.append("date_received <= %s")
+        params.append(end)
+    sql = """
+        SELECT region, csr_problem_type, count FROM (
+            SELECT resolved_apc AS region, csr_problem_type, COUNT(*) AS count,
+                ROW_NUMBER() OVER (
+                    PARTITION BY resolved_apc
+                    ORDER BY COUNT(*) DESC, csr_problem_type
+                ) AS rank
+            FROM %s
+            WHERE %s
+            GROUP BY resolved_apc, csr_problem_type
+        ) ranked
+        WHERE rank <= %%s
+        ORDER BY region, rank
+    """ % (qn(Complaint._meta.db_table), " AND ".join(where))
+    cursor = connection.cursor()
+    cursor.execute(sql, params + [n])
+    for region, problem_type, count in cursor.fetchall():
+        top[region].append({'csr_problem_type': problem_type, 'count': count})
+    return top
+
+
+def refresh_precomputed(rebuild_histograms=True):
+    """
+    Refresh everything we precompute from the complaints table.
+    Call this whenever the complaints change in bulk.
+
+    Pass rebuild_histograms=False if the survival histograms
+    have already been updated incrementally.
+    """
+    if rebuild_histograms:
+        SurvivalHistogram.objects.rebuild()
+    refresh_summaries()
+    # Anything cached from the old data is out of date now
+    version = bump_data_version()
+    # And the published GeoJSON files need rewriting for the new version
+    publish(version)
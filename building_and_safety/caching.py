@@ -0,0 +1,122 @@
+"""
+Caching for the expensive things our views compute.
+
+Every key includes a dataset version, which load_complaints bumps,
+so a reload never serves numbers from the old data. When an entry goes stale,
+only one worker recomputes it. Everyone else gets the stale value in the meantime,
+or waits briefly for the fresh one if there's nothing to fall back on.
+"""
+import time
+import hashlib
+from django.core.cache import cache
+
+PREFIX = 'building_and_safety'
+VERSION_KEY = '%s:data_version' % PREFIX
+
+# How long past its expiration a stale value sticks around to be served during a recompute
+STALE_GRACE = 60 * 60
+
+# How long a recompute can hold the lock, and how long other workers wait on it
+LOCK_TIMEOUT = 120
+WAIT_TIMEOUT = 30
+
+STAT_NAMES = ('hits', 'misses', 'stale', 'waits', 'recomputes', 'recompute_ms')
+
+
+def get_data_version():
+    """
+    The current version of the complaints data.
+    If the cache has lost track of it, start a new one.
+    """
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # add() rather than set(), so two workers starting at once agree on a version
+        cache.add(VERSION_KEY, int(time.time() * 1000), None)
+        version = cache.get(VERSION_KEY) or 0
+    return version
+
+
+def bump_data_version():
+    """
+    Move on to a new data version. Everything cached for the old one is ignored from here on.
+    """
+    # Always move forward, even if the last version was started this same millisecond
+    version = max(int(time.time() * 1000), (cache.get(VERSION_KEY) or 0) + 1)
+    cache.set(VERSION_KEY, version, None)
+    return version
+
+
+def incr_stat(name, delta=1):
+    key = '%s:stats:%s' % (PREFIX, name)
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # The counter doesn't exist yet
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            pass
+
+
+def get_stats():
+    """
+    Hit, miss and recompute counters since the cache last restarted.
+    """
+    keys = dict(('%s:stats:%s' % (PREFIX, name), name) for name in STAT_NAMES)
+    values = cache.get_many(keys.keys())
+    stats = dict((name, values.get(key, 0)) for key, name in keys.items())
+    stats['data_version'] = get_data_version()
+    return stats
+
+
+def make_key(name):
+    """
+    A memcached-safe key for a computation at the current data version.
+    """
+    return '%s:%s:%s' % (PREFIX, get_data_version(), hashlib.md5(name).hexdigest())
+
+
+def get_or_compute(name, compute, timeout=None):
+    """
+    Return the cached result of compute() for this name and the current data version,
+    recomputing it if it's missing or stale.
+
+    Only the worker that wins the lock recomputes. The rest get the stale value
+    if there is one, or wait up to WAIT_TIMEOUT seconds for the winner to finish.
+    """
+    if timeout is None:
+        timeout = cache.default_timeout
+    key = make_key(name)
+    entry = cache.get(key)
+    if entry is not None and entry['expires'] > time.time():
+        incr_stat('hits')
+        return entry['value']
+
+    incr_stat('misses')
+    lock_key = '%s:lock' % key
+    if cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            start = time.time()
+            value = compute()
+            elapsed = time.time() - start
+            cache.set(key, {'value': value, 'expires': time.time() + timeout}, timeout + STALE_GRACE)
+        finally:
+            cache.delete(lock_key)
+        incr_stat('recomputes')
+        incr_stat('recompute_ms', int(elapsed * 1000))
+        return value
+
+    if entry is not None:
+        incr_stat('stale')
+        return entry['value']
+
+    # Someone else is already working on it, and there's nothing old to hand out
+    incr_stat('waits')
+    deadline = time.time() + WAIT_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.1)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry['value']
+    return compute()
@@ -0,0 +1,145 @@
+"""
+A compact, columnar alternative to GeoJSON for the complaints on the map.
+
+Instead of a feature object per complaint, each property is one array:
+
+* Coordinates are rounded to COORDINATE_SCALE steps (about a meter) and
+  stored as the difference from the previous complaint. Complaints are put
+  in Z-order first, so neighbors on the map are neighbors in the arrays
+  and the differences stay small.
+* Problem types and priorities are stored once in a dictionary,
+  with a small integer code per complaint.
+* Dates are whole days since an epoch given once in the payload.
+
+It's still JSON, so it gzips well and needs no special parser.
+decode_compact turns it back into the same features as GeoJSON,
+and complaints_map.html has the same decoder in JavaScript.
+"""
+from datetime import date, timedelta
+import numpy as np
+from building_and_safety.geojson import format_date
+
+FORMAT_VERSION = 1
+
+# Coordinates are stored in steps of 1/COORDINATE_SCALE degrees
+COORDINATE_SCALE = 100000
+
+
+def quantize(values):
+    return np.round(np.asarray(values, dtype=float) * COORDINATE_SCALE).astype(np.int64)
+
+
+def delta_encode(values):
+    """
+    The first value, then the difference between each value and the one before it.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if not len(values):
+        return []
+    return np.concatenate(([values[0]], np.diff(values))).tolist()
+
+
+def spread_bits(n):
+    """
+    Spread the low 16 bits of each number out to every other bit, for interleaving.
+    """
+    n = n & 0x0000ffff
+    n = (n | (n << 8)) & 0x00ff00ff
+    n = (n | (n << 4)) & 0x0f0f0f0f
+    n = (n | (n << 2)) & 0x33333333
+    n = (n | (n << 1)) & 0x55555555
+    return n
+
+
+def z_order(x, y):
+    """
+    The order that walks a set of points along a Z-order curve,
+    which keeps points that are close together on the map close together in the list.
+    """
+    if not len(x):
+        return np.zeros(0, dtype=np.int64)
+
+    def scaled(v):
+        span = max(int(v.max() - v.min()), 1)
+        return (v - v.min()) * 65535 // span
+
+    codes = spread_bits(scaled(x)) | (spread_bits(scaled(y)) << 1)
+    return np.argsort(codes, kind='mergesort')
+
+
+def dictionary_encode(values):
+    """
+    The distinct values, and each value's position in that list.
+    """
+    categories = sorted(set(values), key=lambda v: (v is None, v))
+    lookup = dict((v, i) for i, v in enumerate(categories))
+    return categories, [lookup[v] for v in values]
+
+
+def encode_compact(rows):
+    """
+    Pack a list of GEOJSON_FIELDS rows into the compact format.
+    """
+    rows = list(rows)
+    x = quantize([r[0] for r in rows])
+    y = quantize([r[1] for r in rows])
+    order = z_order(x, y)
+    rows = [rows[i] for i in order]
+    x, y = x[order], y[order]
+
+    dates = [r[4] for r in rows] + [r[5] for r in rows]
+    epoch = min([d for d in dates if d is not None] or [date(1970, 1, 1)])
+
+    def days(d):
+        return None if d is None else (d - epoch).days
+
+    types, type_codes = dictionary_encode([r[6] for r in rows])
+    priorities, priority_codes = dictionary_encode([r[7] for r in rows])
+    return {
+        'format': 'compact',
+        'version': FORMAT_VERSION,
+        'count': len(rows),
+        'scale': COORDINATE_SCALE,
+        'epoch': epoch.isoformat(),
+        'lon': delta_encode(x),
+        'lat': delta_encode(y),
+        'address': [r[2] for r in rows],
+        'csr': [r[3] for r in rows],
+        'received': [days(r[4]) for r in rows],
+        'closed': [days(r[5]) for r in rows],
+        'types': types,
+        'type': type_codes,
+        'priorities': priorities,
+        'priority': priority_codes,
+    }
+
+
+def decode_compact(data):
+    """
+    Unpack the compact format into a list of GeoJSON features.
+    """
+    epoch = date(*[int(part) for part in data['epoch'].split('-')])
+
+    def to_date(days):
+        return None if days is None else format_date(epoch + timedelta(days=days))
+
+    lon = np.cumsum(np.asarray(data['lon'], dtype=np.int64)) / float(data['scale'])
+    lat = np.cumsum(np.asarray(data['lat'], dtype=np.int64)) / float(data['scale'])
+    features = []
+    for i in range(data['count']):
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [float(lon[i]), float(lat[i])]
+            },
+            "properties": {
+                "address": data['address'][i],
+                "csr": data['csr'][i],
+                "date": to_date(data['received'][i]),
+                "closed": to_date(data['closed'][i]),
+                "type": data['types'][data['type'][i]],
+                "priority": data['priorities'][data['priority'][i]]
+            }
+        })
+    return features
@@ -0,0 +1,75 @@
+"""
+Stream complaints out as a GeoJSON FeatureCollection without building
+Complaint objects or holding the whole collection in memory.
+
+Only the columns the map needs are read, and features are written out
+in batches as the rows come back from the database.
+"""
+import json
+
+# The columns a feature is built from, in the order values_list returns them
+GEOJSON_FIELDS = ('lon', 'lat', 'full_address', 'csr', 'date_received', 'date_closed',
+    'csr_problem_type', 'csr_priority')
+
+# How many features go out in each chunk of the response
+BATCH_SIZE = 500
+
+MONTH_NAMES = ('January', 'February', 'March', 'April', 'May', 'June', 'July',
+    'August', 'September', 'October', 'November', 'December')
+
+
+def format_date(d):
+    """
+    Format a date like dateformat's 'F j, Y', say July 13, 2014, without its overhead.
+    """
+    if d is None:
+        return None
+    return '%s %s, %s' % (MONTH_NAMES[d.month - 1], d.day, d.year)
+
+
+def row_to_feature(row):
+    """
+    The same dict Complaint.as_geojson_dict makes, from a values_list row.
+    """
+    lon, lat, address, csr, received, closed, problem_type, priority = row
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [float(lon), float(lat)]
+        },
+        "properties": {
+            "address": address,
+            "csr": csr,
+            "date": format_date(received),
+            "closed": format_date(closed),
+            "type": problem_type,
+            "priority": priority
+        }
+    }
+
+
+def iter_geojson(rows, batch_size=BATCH_SIZE):
+    """
+    Yield a FeatureCollection of GEOJSON_FIELDS rows a piece at a time.
+    """
+    yield '{"type": "FeatureCollection", "features": ['
+    batch = []
+    first = True
+    for row in rows:
+        batch.append(json.dumps(row_to_feature(row)))
+        if len(batch) == batch_size:
+            yield ('' if first else ', ') + ', '.join(batch)
+            first = False
+            batch = []
+    if batch:
+        yield ('' if first else ', ') + ', '.join(batch)
+    yield ']}'
+
+
+def iter_queryset_geojson(queryset, batch_size=BATCH_SIZE):
+    """
+    Stream the complaints in a queryset as a FeatureCollection, reading only the columns a feature needs.
+    """
+    rows = queryset.order_by().values_list(*GEOJSON_FIELDS).iterator()
+    return iter_geojson(rows, batch_size)
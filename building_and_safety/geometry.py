@@ -0,0 +1,150 @@
+"""
+Simplify GeoJSON polygons for display at a given zoom level.
+
+Boundaries are thinned with Douglas-Peucker, so no point moves more than
+a tolerance from the original outline, and their coordinates are rounded
+to a grid fine enough that the rounding can't be seen at that zoom.
+"""
+import math
+
+TILE_SIZE = 256
+
+
+def degrees_per_pixel(zoom):
+    """
+    How many degrees of longitude one screen pixel covers at a zoom level.
+    """
+    return 360.0 / (TILE_SIZE * 2 ** zoom)
+
+
+def get_decimals(tolerance):
+    """
+    How many decimal places to keep so rounding moves a point a small fraction of the tolerance.
+    """
+    return max(int(math.ceil(-math.log10(tolerance / 4.0))), 0)
+
+
+def point_line_distance(point, start, end):
+    """
+    The distance from a point to the segment between start and end.
+    """
+    (x, y), (x1, y1), (x2, y2) = point, start, end
+    dx, dy = x2 - x1, y2 - y1
+    if dx == 0 and dy == 0:
+        return math.hypot(x - x1, y - y1)
+    t = max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / float(dx * dx + dy * dy)))
+    return math.hypot(x - (x1 + t * dx), y - (y1 + t * dy))
+
+
+def douglas_peucker(points, tolerance):
+    """
+    Drop every point that's within tolerance of the line its neighbors would make without it.
+    The first and last points are always kept.
+    """
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    # An explicit stack rather than recursion, so long rings can't overflow it
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, distance = None, tolerance
+        for i in range(first + 1, last):
+            d = point_line_distance(points[i], points[first], points[last])
+            if d > distance:
+                farthest, distance = i, d
+        if farthest is not None:
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def ring_area(ring):
+    """
+    The area inside a ring, in square degrees, by the shoelace formula.
+    """
+    return abs(sum(
+        x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1])
+    )) / 2.0
+
+
+def simplify_ring(ring, tolerance, decimals):
+    """
+    Simplify and round a closed ring. Returns None if nothing worth drawing is left.
+    """
+    # Split the ring in two at its far side, so the fixed endpoints don't pin the shape
+    if ring[0] == ring[-1]:
+        ring = ring[:-1]
+    if len(ring) < 3 or ring_area(ring) < tolerance * tolerance:
+        return None
+    x0, y0 = ring[0]
+    middle = max(range(len(ring)), key=lambda i: math.hypot(ring[i][0] - x0, ring[i][1] - y0))
+    simplified = douglas_peucker(ring[:middle + 1], tolerance)[:-1] + douglas_peucker(ring[middle:] + ring[:1], tolerance)
+
+    rounded = []
+    for x, y in simplified:
+        point = [round(x, decimals), round(y, decimals)]
+        if not rounded or point != rounded[-1]:
+            rounded.append(point)
+    if len(rounded) < 4 or ring_area(rounded) < tolerance * tolerance:
+        return None
+    return rounded
+
+
+def simplify_polygon(rings, tolerance, decimals):
+    """
+    Simplify a polygon's rings. A polygon whose outer ring vanishes vanishes with it.
+    """
+    simplified = []
+    for i, ring in enumerate(rings):
+        ring = simplify_ring(ring, tolerance, decimals)
+        if ring is None:
+            if i == 0:
+                return None
+            continue
+        simplified.append(ring)
+    return simplified
+
+
+def simplify_geometry(geometry, tolerance, decimals=None):
+    """
+    A simplified copy of a Polygon or MultiPolygon. Other geometry comes back as it was.
+    """
+    if decimals is None:
+        decimals = get_decimals(tolerance)
+    if geometry['type'] == 'Polygon':
+        rings = simplify_polygon(geometry['coordinates'], tolerance, decimals)
+        return {'type': 'Polygon', 'coordinates': rings or []}
+    if geometry['type'] == 'MultiPolygon':
+        polygons = [simplify_polygon(p, tolerance, decimals) for p in geometry['coordinates']]
+        return {'type': 'MultiPolygon', 'coordinates': [p for p in polygons if p]}
+    return geometry
+
+
+def simplify_collection(collection, zoom):
+    """
+    A copy of a FeatureCollection simplified to about a pixel at a zoom level.
+    """
+    tolerance = degrees_per_pixel(zoom)
+    features = []
+    for feature in collection['features']:
+        features.append({
+            'type': 'Feature',
+            'properties': feature.get('properties', {}),
+            'geometry': simplify_geometry(feature['geometry'], tolerance),
+        })
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def count_points(collection):
+    """
+    How many coordinate pairs a FeatureCollection of polygons holds.
+    """
+    total = 0
+    for feature in collection['features']:
+        geometry = feature['geometry']
+        polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+        total += sum(len(ring) for polygon in polygons for ring in polygon)
+    return total
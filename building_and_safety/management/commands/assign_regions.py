@@ -0,0 +1,22 @@
+import time
+from building_and_safety.regions import get_layers, reassign_regions
+from building_and_safety.analysis import refresh_precomputed
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Check every complaint's location against the polygon layers again, and fix up missing APCs from them."
+
+    def handle(self, *args, **options):
+        layers = get_layers()
+        self.stdout.write("Polygon layers: %s" % (', '.join(
+            '%s (%s polygons)' % (layer.field, len(layer.polygons)) for layer in layers
+        ) or 'none'))
+
+        start = time.time()
+        count = reassign_regions()
+        self.stdout.write("Classified %s complaints in %.2fs" % (count, time.time() - start))
+
+        start = time.time()
+        refresh_precomputed()
+        self.stdout.write("Refreshed precomputed summaries in %.2fs" % (time.time() - start))
@@ -0,0 +1,139 @@
+import os
+import csv
+import time
+import random
+import tempfile
+from datetime import date, timedelta
+from optparse import make_option
+from django.db import connection, transaction
+from building_and_safety.management.commands.load_complaints import Command as LoadCommand
+from django.core.management.base import BaseCommand, CommandError
+
+
+custom_options = (
+    make_option(
+        "--rows",
+        action="store",
+        type="int",
+        dest="rows",
+        default=20000,
+        help="How many rows to put in the synthetic CSV. By default it's 20,000."
+    ),
+    make_option(
+        "--chunk-size",
+        action="store",
+        type="int",
+        dest="chunk_size",
+        default=500,
+        help="How many complaints to write at a time. By default it's 500."
+    ),
+)
+
+FIELDNAMES = [
+    "CSR Number", "LADBS Inspection District", "Address House Number", "Address House Fraction Number",
+    "Address Street Direction", "Address Street Name", "Address Street Suffix", "Address Street Suffix Direction",
+    "Address Street Zip", "Date Received", "Date Closed", "Due Date", "Case Flag", "CSR Priority",
+    "GIS Parcel Identification Number (PIN)", "CSR Problem Type", "Area Planning Commission (APC)",
+    "Case Number Related to CSR", "Response Days", "Latitude/Longitude",
+]
+
+REGIONS = ['Central', 'East Los Angeles', 'Harbor', 'North Valley', 'South Los Angeles', 'South Valley', 'West Los Angeles']
+
+PROBLEM_TYPES = [
+    "FENCES WALLS AND HEDGES THAT ARE TOO HIGH",
+    "CONSTRUCTION WITHOUT PERMITS",
+    "YARD SALES, GARAGE SALES OR OTHER RETAIL SALES IN A RESIDENTIAL ZONE",
+    "ISSUES REGARDING ADULT ENTERTAINMENT LOCATIONS (CLUBS, CABARETS, BOOK AND VIDEO STORES)",
+]
+
+
+class Command(BaseCommand):
+    help = "Compare how fast load_complaints writes with COPY and with the ORM, using a synthetic CSV."
+    option_list = BaseCommand.option_list + custom_options
+
+    def format_date(self, d):
+        return "%s/%s/%s" % (d.month, d.day, d.year)
+
+    def write_synthetic_csv(self, path, rows):
+        """
+        Fill a CSV with made-up complaints that look like the real thing.
+        """
+        start = date(2011, 1, 1)
+        with open(path, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(FIELDNAMES)
+            for i in xrange(rows):
+                received = start + timedelta(days=random.randint(0, 1289))
+                closed = received + timedelta(days=random.randint(0, 400))
+                if closed > date(2014, 7, 13) or random.random() < 0.3:
+                    closed = None
+                due = received + timedelta(days=random.choice([7, 14, 30]))
+                writer.writerow([
+                    100000 + i,
+                    random.randint(1000, 9999),
+                    random.randint(1, 20000),
+                    " ",
+                    random.choice(["N", "S", "E", "W"]),
+                    "MAIN",
+                    "ST",
+                    " ",
+                    random.choice(["90012", "90029", "91367"]),
+                    self.format_date(received),
+                    self.format_date(closed) if closed else "",
+                    self.format_date(due),
+                    random.choice(["Y", "N"]),
+                    random.choice(["NORM", "HIGH", "HAZ"]),
+                    "144B197  1166",
+                    random.choice(PROBLEM_TYPES),
+                    random.choice(REGIONS),
+                    "",
+                    "",
+                    "(%s, %s)" % (round(random.uniform(33.7, 34.3), 5), round(random.uniform(-118.6, -118.1), 5)),
+                ])
+
+    def time_writer(self, loader, path, write_chunk, chunk_size):
+        """
+        Time a full pass through the load pipeline, rolling back afterward
+        so the benchmark leaves the database the way it found it.
+        """
+        with transaction.atomic():
+            sid = transaction.savepoint()
+            start = time.time()
+            complaints = loader.iter_complaints(loader.iter_rows([path]), chunk_size)
+            for chunk in loader.iter_chunks(complaints, chunk_size):
+                write_chunk(chunk)
+            elapsed = time.time() - start
+            transaction.savepoint_rollback(sid)
+        return elapsed
+
+    def handle(self, *args, **options):
+        rows = options['rows']
+        if rows < 1:
+            raise CommandError("--rows must be a positive number.")
+
+        fd, path = tempfile.mkstemp(suffix='.csv')
+        os.close(fd)
+        try:
+            self.write_synthetic_csv(path, rows)
+            loader = LoadCommand()
+
+            writers = [('orm', loader.write_chunk_orm)]
+            if connection.vendor == 'postgresql':
+                writers.append(('copy', loader.write_chunk_copy))
+            else:
+                self.stdout.write("COPY needs PostgreSQL; only timing the ORM.")
+
+            results = {}
+            for name, write_chunk in writers:
+                elapsed = self.time_writer(loader, path, write_chunk, options['chunk_size'])
+                results[name] = elapsed
+                self.stdout.write("%s: %s rows in %.2fs (%.0f rows/sec)" % (
+                    name, rows, elapsed, rows / max(elapsed, 0.000001)
+                ))
+
+            if 'copy' in results:
+                self.stdout.write("COPY is %.1fx faster than the ORM." % (
+                    results['orm'] / max(results['copy'], 0.000001)
+                ))
+        finally:
+            os.remove(path)
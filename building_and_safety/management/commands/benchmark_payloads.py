@@ -0,0 +1,30 @@
+import json
+import zlib
+from building_and_safety.tiles import get_map_complaints
+from building_and_safety.geojson import GEOJSON_FIELDS, iter_geojson
+from building_and_safety.compact import encode_compact
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Compare the size of the map's GeoJSON payloads against the compact format, raw and gzipped."
+
+    def gzipped_size(self, data):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return len(compressor.compress(data) + compressor.flush())
+
+    def handle(self, *args, **options):
+        for label, is_closed in (('Open', False), ('Closed', True)):
+            rows = list(get_map_complaints().filter(is_closed=is_closed).order_by().values_list(*GEOJSON_FIELDS))
+            geojson = ''.join(iter_geojson(rows))
+            compact = json.dumps(encode_compact(rows))
+            sizes = [
+                ('GeoJSON', len(geojson), self.gzipped_size(geojson)),
+                ('Compact', len(compact), self.gzipped_size(compact)),
+            ]
+            self.stdout.write("%s complaints (%s):" % (label, len(rows)))
+            for name, raw, gzipped in sizes:
+                self.stdout.write("  %s: %s bytes, %s gzipped" % (name, raw, gzipped))
+            self.stdout.write("  Compact is %.1f%% of GeoJSON raw and %.1f%% gzipped" % (
+                100.0 * sizes[1][1] / max(sizes[0][1], 1), 100.0 * sizes[1][2] / max(sizes[0][2], 1)
+            ))
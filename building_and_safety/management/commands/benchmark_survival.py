@@ -0,0 +1,44 @@
+import time
+from django.db import reset_queries
+from building_and_safety.models import Complaint, REGION_NAMES
+from building_and_safety.views import get_kmf_fit, get_kmf_median
+from building_and_safety.survival import fit_complaint_strata, PRIORITIES
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Compare the NumPy Kaplan-Meier engine against fitting each stratum with lifelines."
+
+    def fit_with_lifelines(self):
+        """
+        The way ComplaintAnalysis used to do it: two queries and a fit for each of the 32 strata.
+        """
+        medians = {}
+        all_complaints = Complaint.objects.filter(days_since_complaint__gte=0)
+        for region in [None] + list(REGION_NAMES):
+            qs = all_complaints
+            if region:
+                qs = qs.filter(resolved_apc=region)
+            medians[(region, None)] = get_kmf_median(get_kmf_fit(qs))
+            for priority in PRIORITIES:
+                medians[(region, priority)] = get_kmf_median(get_kmf_fit(qs.filter(csr_priority=priority)))
+        return medians
+
+    def handle(self, *args, **options):
+        start = time.time()
+        expected = self.fit_with_lifelines()
+        lifelines_time = time.time() - start
+        reset_queries()
+
+        start = time.time()
+        strata = fit_complaint_strata()
+        engine_time = time.time() - start
+
+        mismatches = [key for key, median in expected.items() if strata[key].median_ != median]
+        self.stdout.write("lifelines, one stratum at a time: %.3fs" % lifelines_time)
+        self.stdout.write("NumPy engine, all %s strata from one fetch: %.3fs" % (len(strata), engine_time))
+        self.stdout.write("Speedup: %.1fx" % (lifelines_time / max(engine_time, 0.000001)))
+        if mismatches:
+            self.stdout.write("Medians differ for: %s" % ', '.join(str(key) for key in mismatches))
+        else:
+            self.stdout.write("Every median matches.")
@@ -0,0 +1,51 @@
+import os
+import gzip
+import json
+from optparse import make_option
+from django.conf import settings
+from building_and_safety.geometry import simplify_collection, count_points
+from django.core.management.base import BaseCommand, CommandError
+
+# The zoom levels the map shows each simplified boundary at. Each is simplified
+# to about a pixel at the closest zoom in its band, and named for the furthest out.
+ZOOM_BANDS = ((11, 12), (13, 14), (15, 16))
+
+
+def get_band_path(source, min_zoom):
+    root, extension = os.path.splitext(source)
+    return '%s.z%s%s' % (root, min_zoom, extension)
+
+
+class Command(BaseCommand):
+    help = "Write simplified, gzipped copies of the city boundary for each band of zoom levels on the map."
+    option_list = BaseCommand.option_list + (
+        make_option('--source',
+            dest='source',
+            default=os.path.join(settings.ROOT_DIR, 'templates', 'static', 'json', 'la_city.json'),
+            help='The full-resolution GeoJSON boundary to simplify.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        source = options['source']
+        if not os.path.exists(source):
+            raise CommandError("Can't find %s" % source)
+        with open(source) as f:
+            collection = json.load(f)
+        self.stdout.write("%s: %s points, %s bytes" % (
+            os.path.basename(source), count_points(collection), os.path.getsize(source)
+        ))
+
+        for min_zoom, max_zoom in ZOOM_BANDS:
+            simplified = simplify_collection(collection, max_zoom)
+            data = json.dumps(simplified, separators=(',', ':'), sort_keys=True)
+            path = get_band_path(source, min_zoom)
+            with open(path, 'wb') as f:
+                f.write(data)
+            # A fixed mtime so rebuilding the same boundary gives the same bytes
+            with open(path + '.gz', 'wb') as raw:
+                with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=raw, mtime=0) as f:
+                    f.write(data)
+            self.stdout.write("Zoom %s-%s: %s points, %s bytes, %s gzipped" % (
+                min_zoom, max_zoom, count_points(simplified), len(data), os.path.getsize(path + '.gz')
+            ))
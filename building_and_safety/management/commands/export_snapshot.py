@@ -0,0 +1,25 @@
+import os
+import time
+from django.conf import settings
+from building_and_safety.models import Complaint
+from building_and_safety.snapshot import write_snapshot
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    args = '[path]'
+    help = "Write a columnar snapshot of the complaints table that can be memory-mapped into pandas."
+
+    def handle(self, *args, **options):
+        if len(args) > 1:
+            raise CommandError("Give at most one path to write the snapshot to.")
+        if args:
+            path = args[0]
+        else:
+            path = os.path.join(settings.ROOT_DIR, 'building_and_safety', 'data', 'snapshot')
+
+        start = time.time()
+        meta = write_snapshot(Complaint, path)
+        self.stdout.write("Wrote %s complaints, %s fields, to %s in %.2fs" % (
+            meta['count'], len(meta['fields']), path, time.time() - start
+        ))
@@ -1,17 +1,102 @@
 import os
+import re
 import csv
+import time
+import hashlib
 import logging
+import resource
 from datetime import datetime
+from itertools import islice
+from functools import partial
+from collections import deque
+from multiprocessing import Pool
+from cStringIO import StringIO
+from optparse import make_option
 from django.conf import settings
+from django.db import connection, reset_queries, transaction
+from django.db.models import AutoField
+from django.utils.encoding import force_text
 from django.contrib.gis.geos import Point
-from building_and_safety.models import Complaint
+from building_and_safety.models import Complaint, SourceFile, SurvivalHistogram, RAW_FIELDS, DERIVED_FIELDS, get_as_of_date
+from building_and_safety.derived import derive_complaints
+from building_and_safety.regions import assign_regions
+from building_and_safety.analysis import refresh_precomputed
 from ast import literal_eval as make_tuple
 from django.core.management.base import BaseCommand, CommandError
 
 logger = logging.getLogger(__name__)
 
+# Roughly how much of a CSV each worker parses at a time
+RANGE_BYTES = 4 * 1024 * 1024
+
+
+custom_options = (
+    make_option(
+        "--chunk-size",
+        action="store",
+        type="int",
+        dest="chunk_size",
+        default=500,
+        help="How many complaints to parse and write to the database at a time. \
+By default it's 500."
+    ),
+    make_option(
+        "--no-copy",
+        action="store_false",
+        dest="use_copy",
+        default=True,
+        help="Write with the ORM's bulk_create even when the database is \
+PostgreSQL, instead of streaming rows in with COPY."
+    ),
+    make_option(
+        "--incremental",
+        action="store_true",
+        dest="incremental",
+        default=False,
+        help="Don't flush the table. Insert new complaints and update the ones \
+whose raw data changed, matching on CSR number. Fields filled out by hand are left alone."
+    ),
+    make_option(
+        "--workers",
+        action="store",
+        type="int",
+        dest="workers",
+        default=1,
+        help="How many processes to parse the CSVs with. By default it's 1."
+    ),
+    make_option(
+        "--atomic",
+        action="store_true",
+        dest="atomic",
+        default=False,
+        help="Load into a staging copy of the table, index it and swap it in \
+inside one transaction, so the site never sees a half-loaded table. PostgreSQL only."
+    ),
+    make_option(
+        "--force",
+        action="store_true",
+        dest="force",
+        default=False,
+        help="Load the CSVs even if they haven't changed since the last successful load."
+    ),
+)
+
+
+def parse_byte_range(args):
+    """
+    Parse the rows between two byte offsets of a CSV.
+    This lives out here, rather than on the Command, so multiprocessing can pickle it.
+    """
+    path, start, end, fieldnames = args
+    return Command().parse_range(path, start, end, fieldnames)
+
+
 class Command(BaseCommand):
     help = "Load complaints filed to the city department of building and safety into the database."
+    option_list = BaseCommand.option_list + custom_options
+
+    # Our two CSVs of open and closed cases
+    paths = ['Building_and_Safety_Customer_Service_Request_out.csv', 'Building_and_Safety_Customer_Service_Request__Closed__out.csv']
 
     def parse_booleans(self, value):
         """
@@ -48,15 +133,6 @@ class Command(BaseCommand):
         else:
             return (None, None)
 
-    def get_is_closed(self, c):
-        """
-        If there's no closed date, a complaint is still "open"
-        """
-        if c.date_closed != None:
-            return True
-        else:
-            return False
-
     def parse_priority(self, p):
         """
         Convert the values in a spreadsheet to integers
@@ -85,70 +161,534 @@ class Command(BaseCommand):
         else:
             return s
 
+    def build_complaint(self, row):
+        """
+        Create a Complaint object from a row in the CSV.
+        The derived fields are filled in later, a batch at a time.
+        """
+        lon, lat = self.parse_lat_lon(row["Latitude/Longitude"])
+        c = Complaint(
+            csr = row["CSR Number"],
+            ladbs_inspection_district = row["LADBS Inspection District"] ,
+            address_house_number = row["Address House Number"],
+            address_house_fraction = row["Address House Fraction Number"],
+            address_street_direction = row["Address Street Direction"],
+            address_street_name = row["Address Street Name"],
+            address_street_suffix = row["Address Street Suffix"],
+            address_street_suffix_direction = row["Address Street Suffix Direction"],
+            address_street_zip = row["Address Street Zip"],
+            date_received = self.parse_date(row["Date Received"]),
+            date_closed = self.parse_date(row["Date Closed"]),
+            date_due = self.parse_date(row["Due Date"]),
+            case_flag = self.parse_booleans(row["Case Flag"]),
+            csr_priority = self.parse_priority(row["CSR Priority"]),
+            gis_pin = row["GIS Parcel Identification Number (PIN)"],
+            csr_problem_type = row["CSR Problem Type"],
+            area_planning_commission = row["Area Planning Commission (APC)"],
+            case_number_csr = row["Case Number Related to CSR"],
+            response_days = self.parse_int(row["Response Days"]),
+            lat = lat,
+            lon = lon
+            )
+        return c
+
+    def iter_rows(self, paths):
+        """
+        Read the CSVs one row at a time, so we never hold a whole file in memory.
+        """
+        for path in paths:
+            with open(path, 'r') as f:
+                for row in csv.DictReader(f):
+                    yield row
+
+    def iter_complaints(self, rows, chunk_size=500):
+        """
+        Turn a stream of CSV rows into a stream of Complaint objects.
+
+        Rather than calling back to methods on the Complaint model for every object,
+        the derived fields and the polygons each complaint falls in are worked out
+        for a chunk at a time in vectorized passes.
+        """
+        complaints = (self.build_complaint(row) for row in rows)
+        for chunk in self.iter_chunks(complaints, chunk_size):
+            for c in assign_regions(derive_complaints(chunk)):
+                yield c
+
+    def get_byte_ranges(self, path, parts):
+        """
+        Split a CSV into about `parts` byte ranges that each start at the beginning of a line.
+        Returns (path, start, end, fieldnames) tuples ready to hand to parse_byte_range.
+
+        This assumes no quoted field in the file contains a line break,
+        which holds for the LADBS exports.
+        """
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            fieldnames = next(csv.reader([f.readline()]))
+            data_start = f.tell()
+            offsets = [data_start]
+            for i in range(1, parts):
+                f.seek(data_start + (size - data_start) * i // parts)
+                # Finish off whatever line we landed in
+                f.readline()
+                offsets.append(max(f.tell(), offsets[-1]))
+            offsets.append(size)
+        return [(path, start, end, fieldnames) for start, end in zip(offsets, offsets[1:]) if end > start]
+
+    def parse_range(self, path, start, end, fieldnames):
+        """
+        Build Complaint objects from the lines in one byte range of a CSV.
+        """
+        with open(path, 'rb') as f:
+            f.seek(start)
+            lines = f.read(end - start).splitlines(True)
+        complaints = [self.build_complaint(row) for row in csv.DictReader(lines, fieldnames=fieldnames)]
+        return assign_regions(derive_complaints(complaints))
+
+    def iter_complaints_parallel(self, paths, workers):
+        """
+        Parse the CSVs in a pool of processes and stream the results back in file order.
+
+        Only a couple of ranges per worker are in flight at once,
+        so a slow database doesn't let parsed complaints pile up in memory.
+        """
+        ranges = []
+        for path in paths:
+            parts = max(workers * 4, os.path.getsize(path) // RANGE_BYTES)
+            ranges.extend(self.get_byte_ranges(path, parts))
+        ranges = iter(ranges)
+
+        # Don't let the forked workers inherit our database connection
+        connection.close()
+        pool = Pool(workers)
+        try:
+            pending = deque(pool.apply_async(parse_byte_range, (r,)) for r in islice(ranges, workers * 2))
+            while pending:
+                complaints = pending.popleft().get()
+                for r in islice(ranges, 1):
+                    pending.append(pool.apply_async(parse_byte_range, (r,)))
+                for c in complaints:
+                    yield c
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def iter_chunks(self, iterable, chunk_size):
+        """
+        Group a stream into lists of at most chunk_size items.
+        """
+        iterator = iter(iterable)
+        while True:
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+    def get_copy_fields(self):
+        """
+        Every column we fill in ourselves, which is all of them but the primary key.
+        """
+        return [f for f in Complaint._meta.local_fields if not isinstance(f, AutoField)]
+
+    def copy_value(self, value):
+        """
+        Format a value for PostgreSQL's COPY text format.
+        """
+        if value is None:
+            return '\\N'
+        if value is True:
+            return 't'
+        if value is False:
+            return 'f'
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        elif isinstance(value, float):
+            value = repr(value)
+        else:
+            value = str(value)
+        return value.replace('\\', '\\\\').replace('\t', '\\t')\
+            .replace('\n', '\\n').replace('\r', '\\r')
+
+    def write_chunk_orm(self, chunk):
+        """
+        Batch upload a chunk of complaints to the database in one go.
+        """
+        Complaint.objects.bulk_create(chunk)
+
+    def write_chunk_copy(self, chunk, table=None):
+        """
+        Write a chunk of complaints into an in-memory buffer
+        and send the whole thing to PostgreSQL with a single COPY.
+        """
+        table = table or Complaint._meta.db_table
+        fields = self.get_copy_fields()
+        buf = StringIO()
+        for c in chunk:
+            values = [f.get_db_prep_save(getattr(c, f.attname), connection=connection) for f in fields]
+            buf.write('\t'.join(self.copy_value(v) for v in values))
+            buf.write('\n')
+        buf.seek(0)
+
+        qn = connection.ops.quote_name
+        sql = "COPY %s (%s) FROM STDIN" % (qn(table), ', '.join(qn(f.column) for f in fields))
+        cursor = connection.cursor()
+        cursor.copy_expert(sql, buf)
+
+    def normalize(self, field, value):
+        """
+        Coerce a value to what the database hands back for that field,
+        so a CSV string and a stored integer compare as equal.
+        """
+        value = field.to_python(value)
+        if isinstance(value, str):
+            value = force_text(value)
+        return value
+
+    def get_values(self, values, names):
+        """
+        Pick the named fields out of a dict of values, normalized for comparison.
+        """
+        return dict(
+            (name, self.normalize(Complaint._meta.get_field(name), values[name]))
+            for name in names
+        )
+
+    def get_raw_values(self, c):
+        """
+        The normalized raw data fields for a complaint.
+        """
+        return self.get_values(dict((name, getattr(c, name)) for name in RAW_FIELDS), RAW_FIELDS)
+
+    def upsert_chunk(self, chunk, write_chunk):
+        """
+        Compare a chunk of complaints against what's already in the database by CSR number.
+        New complaints are inserted, changed ones get their raw and derived fields updated,
+        and anything a reporter filled in by hand is never touched.
+
+        A complaint whose raw data is the same but whose derived fields have moved,
+        say because the as-of date did, gets just its derived fields rewritten.
+        Those are grouped by their new values, so a day's worth of open complaints
+        costs one UPDATE rather than one per row. Nothing else is written.
+
+        Returns counts of how many complaints were inserted, updated and left unchanged.
+        Changes to the survival histograms pile up in self.histogram_changes.
+        """
+        csr_field = Complaint._meta.get_field('csr')
+        existing = {}
+        csrs = set(self.normalize(csr_field, c.csr) for c in chunk)
+        for row in Complaint.objects.filter(csr__in=csrs).values('id', *(RAW_FIELDS + DERIVED_FIELDS)):
+            pk = row.pop('id')
+            observation = (row['resolved_apc'], row['csr_priority'], row['days_since_complaint'], row['is_closed'])
+            raw = self.get_values(row, RAW_FIELDS)
+            derived = self.get_values(row, DERIVED_FIELDS)
+            existing.setdefault(raw['csr'], []).append((pk, raw, derived, observation))
+
+        new, updated, unchanged = [], 0, 0
+        rederived = {}
+        for c in chunk:
+            raw = self.get_raw_values(c)
+            derived = self.get_values(dict((name, getattr(c, name)) for name in DERIVED_FIELDS), DERIVED_FIELDS)
+            observation = (c.resolved_apc, raw['csr_priority'], c.days_since_complaint, c.is_closed)
+            matches = existing.get(raw['csr'])
+            if not matches:
+                new.append(c)
+                self.histogram_changes[1].append(observation)
+                continue
+            for pk, stored, stored_derived, old_observation in matches:
+                if stored == raw and stored_derived == derived:
+                    unchanged += 1
+                    continue
+                if stored == raw:
+                    key = tuple(derived[name] for name in DERIVED_FIELDS)
+                    rederived.setdefault(key, []).append(pk)
+                else:
+                    values = dict((name, getattr(c, name)) for name in RAW_FIELDS + DERIVED_FIELDS)
+                    Complaint.objects.filter(pk=pk).update(**values)
+                self.histogram_changes[0].append(old_observation)
+                self.histogram_changes[1].append(observation)
+                updated += 1
+
+        for key, pks in rederived.items():
+            Complaint.objects.filter(pk__in=pks).update(**dict(zip(DERIVED_FIELDS, key)))
+        if new:
+            write_chunk(new)
+        return len(new), updated, unchanged
+
+    def get_fingerprint(self, path):
+        """
+        Hash a CSV's contents and count its rows, a block at a time.
+        """
+        sha1 = hashlib.sha1()
+        lines = 0
+        with open(path, 'rb') as f:
+            for block in iter(partial(f.read, 1024 * 1024), ''):
+                sha1.update(block)
+                lines += block.count('\n')
+        # Don't count the header
+        return sha1.hexdigest(), max(lines - 1, 0)
+
+    def get_changed_paths(self, paths, fingerprints):
+        """
+        The paths whose contents differ from the last successful load,
+        or whose complaints were measured against a different as-of date than we'd use now.
+        """
+        as_of = get_as_of_date()
+        stored = dict(
+            (f.name, (f.sha1, f.as_of))
+            for f in SourceFile.objects.filter(name__in=[os.path.basename(p) for p in paths])
+        )
+        return [p for p in paths if stored.get(os.path.basename(p)) != (fingerprints[p][0], as_of)]
+
+    def save_fingerprints(self, paths, fingerprints):
+        """
+        Remember what each file looked like once it's been loaded,
+        and the date its complaints were measured against.
+        """
+        as_of = get_as_of_date()
+        for path in paths:
+            source_file, created = SourceFile.objects.get_or_create(
+                name=os.path.basename(path),
+                defaults={'sha1': fingerprints[path][0], 'row_count': fingerprints[path][1], 'as_of': as_of}
+            )
+            if not created:
+                source_file.sha1, source_file.row_count = fingerprints[path]
+                source_file.as_of = as_of
+                source_file.save()
+
+    def get_staging_table(self):
+        return '%s_staging' % Complaint._meta.db_table
+
+    def get_staging_name(self, name):
+        """
+        A short, stable temporary name for an index or constraint on the staging table,
+        so we don't bump into PostgreSQL's 63 character limit.
+        """
+        return 'stg_%s' % hashlib.md5(name).hexdigest()[:16]
+
+    def create_staging_table(self):
+        """
+        Start a fresh, empty copy of the complaints table without any indexes,
+        which would only slow down the load.
+        """
+        qn = connection.ops.quote_name
+        live, staging = Complaint._meta.db_table, self.get_staging_table()
+        cursor = connection.cursor()
+        cursor.execute("DROP TABLE IF EXISTS %s" % qn(staging))
+        cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)" % (qn(staging), qn(live)))
+
+    def drop_staging_table(self):
+        cursor = connection.cursor()
+        cursor.execute("DROP TABLE IF EXISTS %s" % connection.ops.quote_name(self.get_staging_table()))
+
+    def get_live_indexes(self):
+        """
+        The name, definition and whether it's the primary key
+        for every index on the live complaints table.
+        """
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT i.relname, pg_get_indexdef(i.oid), ix.indisprimary
+            FROM pg_index ix
+            JOIN pg_class i ON i.oid = ix.indexrelid
+            JOIN pg_class t ON t.oid = ix.indrelid
+            WHERE t.relname = %s
+        """, [Complaint._meta.db_table])
+        return cursor.fetchall()
+
+    def build_staging_indexes(self):
+        """
+        Copy each index on the live table onto the loaded staging table under a temporary name.
+        Returns pairs of temporary and final names to rename after the swap.
+        """
+        qn = connection.ops.quote_name
+        staging = self.get_staging_table()
+        cursor = connection.cursor()
+        renames = []
+        for name, definition, is_primary in self.get_live_indexes():
+            temp_name = self.get_staging_name(name)
+            if is_primary:
+                cursor.execute("ALTER TABLE %s ADD CONSTRAINT %s PRIMARY KEY (%s)" % (
+                    qn(staging), qn(temp_name), qn(Complaint._meta.pk.column)
+                ))
+            else:
+                definition = re.sub(
+                    r'^(CREATE (?:UNIQUE )?INDEX) \S+ ON \S+',
+                    r'\1 %s ON %s' % (qn(temp_name), qn(staging)),
+                    definition
+                )
+                cursor.execute(definition)
+            renames.append((temp_name, name, is_primary))
+        cursor.execute("ANALYZE %s" % qn(staging))
+        return renames
+
+    def swap_staging_table(self, renames):
+        """
+        Replace the live table with the staging table in a single transaction.
+        Readers see either the old complaints or the new ones, never a mix,
+        and only wait for a couple of catalog updates rather than a delete.
+        """
+        qn = connection.ops.quote_name
+        live, staging = Complaint._meta.db_table, self.get_staging_table()
+        pk = Complaint._meta.pk.column
+        with transaction.atomic():
+            cursor = connection.cursor()
+            # Hand the id sequence over, or dropping the old table would take it along
+            cursor.execute("SELECT pg_get_serial_sequence(%s, %s)", [live, pk])
+            sequence = cursor.fetchone()[0]
+            if sequence:
+                cursor.execute("ALTER SEQUENCE %s OWNED BY %s.%s" % (sequence, qn(staging), qn(pk)))
+            cursor.execute("DROP TABLE %s" % qn(live))
+            cursor.execute("ALTER TABLE %s RENAME TO %s" % (qn(staging), qn(live)))
+            for temp_name, name, is_primary in renames:
+                if is_primary:
+                    cursor.execute("ALTER TABLE %s RENAME CONSTRAINT %s TO %s" % (qn(live), qn(temp_name), qn(name)))
+                else:
+                    cursor.execute("ALTER INDEX %s RENAME TO %s" % (qn(temp_name), qn(name)))
+
+    def get_writer(self, use_copy=True):
+        """
+        COPY is much faster, but it's PostgreSQL-only.
+        Everyone else gets bulk_create.
+        """
+        if use_copy and connection.vendor == 'postgresql':
+            return self.write_chunk_copy
+        return self.write_chunk_orm
+
+    def get_peak_rss(self):
+        """
+        The most memory, in megabytes, this process has held so far.
+        Linux reports ru_maxrss in kilobytes.
+        """
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
     def handle(self, *args, **options):
         """
-        Load in our CSVs of open and closed complaints, 
-        creating Complaint objects and adding them to a list
-        which is then batch loaded into the database.
+        Load in our CSVs of open and closed complaints.
+
+        Rows stream through a pipeline of generators: they're read, turned into
+        Complaint objects and written to the database a chunk at a time,
+        so memory use stays flat no matter how big the files get.
 
-        We batch load them to keep from hitting the database for every record, 
-        which would take approximately forever. 
+        We batch load them to keep from hitting the database for every record,
+        which would take approximately forever.
         """
+        self.verbosity = int(options.get('verbosity', 1))
+        chunk_size = options['chunk_size']
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be a positive number.")
+        if options['workers'] < 1:
+            raise CommandError("--workers must be a positive number.")
+
+        write_chunk = self.get_writer(options['use_copy'])
+        incremental = options['incremental']
+        atomic = options['atomic']
+        if atomic:
+            if incremental:
+                raise CommandError("--atomic reloads the whole table, so it can't be combined with --incremental.")
+            if connection.vendor != 'postgresql' or not options['use_copy']:
+                raise CommandError("--atomic needs PostgreSQL and COPY.")
+            write_chunk = partial(self.write_chunk_copy, table=self.get_staging_table())
+
         self.data_dir = os.path.join(settings.ROOT_DIR, 'building_and_safety', 'data')
-        logger.debug("flushing complaints")
-        self.flush_complaints()
-
-        complaint_list = []
-
-        # Our two CSVs of open and closed cases
-        paths = ['Building_and_Safety_Customer_Service_Request_out.csv', 'Building_and_Safety_Customer_Service_Request__Closed__out.csv']
-
-        for p in paths: 
-            path = os.path.join(self.data_dir, p)
-            reader = csv.DictReader(open(path, 'r'))
-            for row in reader:
-                c = Complaint(
-                    csr = row["CSR Number"],
-                    ladbs_inspection_district = row["LADBS Inspection District"] ,
-                    address_house_number = row["Address House Number"],
-                    address_house_fraction = row["Address House Fraction Number"],
-                    address_street_direction = row["Address Street Direction"],
-                    address_street_name = row["Address Street Name"],
-                    address_street_suffix = row["Address Street Suffix"],
-                    address_street_suffix_direction = row["Address Street Suffix Direction"],
-                    address_street_zip = row["Address Street Zip"],
-                    date_received = self.parse_date(row["Date Received"]),
-                    date_closed = self.parse_date(row["Date Closed"]),
-                    date_due = self.parse_date(row["Due Date"]),
-                    case_flag = self.parse_booleans(row["Case Flag"]),
-                    csr_priority = self.parse_priority(row["CSR Priority"]),
-                    gis_pin = row["GIS Parcel Identification Number (PIN)"],
-                    csr_problem_type = row["CSR Problem Type"],
-                    area_planning_commission = row["Area Planning Commission (APC)"],
-                    case_number_csr = row["Case Number Related to CSR"],
-                    response_days = self.parse_int(row["Response Days"]),
-                    lat = self.parse_lat_lon(row["Latitude/Longitude"])[1],
-                    lon = self.parse_lat_lon(row["Latitude/Longitude"])[0]
-                    )
-                
-                # Here, we call back to methods on the Complaint model. 
-                c.is_closed = self.get_is_closed(c)
-                c.days_since_complaint = c.get_days_since_complaint()
-                c.more_than_one_year = c.get_gt_t_days(365)
-                c.gt_180_days = c.get_gt_t_days(180)
-                c.gt_90_days = c.get_gt_t_days(90)
-                c.gt_30_days = c.get_gt_t_days(30)
-
-                if c.date_due:
-                    c.past_due_date, c.days_past_due_date = c.get_days_past_due()
-                c.full_address = c.get_full_address()
-
-                complaint_list.append(c)
+        paths = [os.path.join(self.data_dir, p) for p in self.paths]
+        for path in paths:
+            if not os.path.exists(path):
+                raise CommandError("Can't find %s" % path)
+
+        # Skip the work entirely if the files are the same as last time.
+        # Loading incrementally, we can skip just the files that haven't changed.
+        fingerprints = dict((path, self.get_fingerprint(path)) for path in paths)
+        changed = self.get_changed_paths(paths, fingerprints)
+        if not options['force']:
+            for path in paths:
+                if path not in changed:
+                    self.stdout.write("%s is unchanged since the last load (%s rows)" % (
+                        os.path.basename(path), fingerprints[path][1]
+                    ))
+            if not changed:
+                self.stdout.write("Nothing has changed; skipping the load. Use --force to load anyway.")
+                return
+            if incremental:
+                paths = changed
+                self.stdout.write("Loading only the changed files: %s" % ', '.join(os.path.basename(p) for p in paths))
+            else:
+                self.stdout.write("Something changed; reloading every file.")
+        else:
+            self.stdout.write("Forcing a load of every file.")
+
+        if atomic:
+            logger.debug("creating staging table")
+            self.create_staging_table()
+        elif not incremental:
+            logger.debug("flushing complaints")
+            self.flush_complaints()
+
+        if options['workers'] > 1:
+            complaints = self.iter_complaints_parallel(paths, options['workers'])
+        else:
+            complaints = self.iter_complaints(self.iter_rows(paths), chunk_size)
 
         logger.debug("Loading complaints to database.")
+        try:
+            total, inserted, updated, unchanged = self.load(complaints, write_chunk, chunk_size, incremental)
+            if atomic:
+                logger.debug("indexing and swapping in staging table")
+                self.swap_staging_table(self.build_staging_indexes())
+        except:
+            if atomic:
+                self.drop_staging_table()
+            raise
+
+        self.save_fingerprints(paths, fingerprints)
+
+        if incremental:
+            logger.debug("updating survival histograms")
+            removed, added = self.histogram_changes
+            SurvivalHistogram.objects.apply_changes(removed, added)
+
+        logger.debug("refreshing precomputed summaries")
+        refresh_precomputed(rebuild_histograms=not incremental)
+
+    def load(self, complaints, write_chunk, chunk_size, incremental=False):
+        """
+        Write a stream of complaints to the database a chunk at a time, reporting as we go.
+        Returns how many complaints we handled, and how many were inserted, updated
+        and left unchanged when loading incrementally.
+        """
+        total = 0
+        inserted, updated, unchanged = 0, 0, 0
+        # Observations that left and joined the survival histograms: (removed, added)
+        self.histogram_changes = ([], [])
+        load_start = tick = time.time()
+        for i, chunk in enumerate(self.iter_chunks(complaints, chunk_size), 1):
+            if incremental:
+                # One transaction per chunk, rather than one per updated row
+                with transaction.atomic():
+                    counts = self.upsert_chunk(chunk, write_chunk)
+                inserted += counts[0]
+                updated += counts[1]
+                unchanged += counts[2]
+            else:
+                write_chunk(chunk)
+            # With DEBUG on, Django remembers every query it runs. Forget them,
+            # or they'll grow right along with the data.
+            reset_queries()
+
+            now = time.time()
+            elapsed = max(now - tick, 0.000001)
+            total += len(chunk)
+            if self.verbosity >= 1:
+                self.stdout.write("Chunk %s: %s rows in %.2fs (%.0f rows/sec), peak RSS %.1f MB" % (
+                    i, len(chunk), elapsed, len(chunk) / elapsed, self.get_peak_rss()
+                ))
+            tick = now
 
-        # Batch upload our complaints to the database, 500 at a time
-        Complaint.objects.bulk_create(
-            complaint_list,
-            batch_size=500
-        )
\ No newline at end of file
+        elapsed = max(time.time() - load_start, 0.000001)
+        if self.verbosity >= 1:
+            self.stdout.write("Loaded %s complaints in %.2fs (%.0f rows/sec), peak RSS %.1f MB" % (
+                total, elapsed, total / elapsed, self.get_peak_rss()
+            ))
+            if incremental:
+                self.stdout.write("%s inserted, %s updated, %s unchanged" % (inserted, updated, unchanged))
+        return total, inserted, updated, unchanged
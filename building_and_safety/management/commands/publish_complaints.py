@@ -0,0 +1,18 @@
+import time
+from building_and_safety.publish import publish, get_publish_root
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Write the map's GeoJSON, plain and compressed, to the files the API serves."
+
+    def handle(self, *args, **options):
+        start = time.time()
+        manifest = publish()
+        for name, info in sorted(manifest['artifacts'].items()):
+            self.stdout.write("%s: %s" % (name, ', '.join(
+                '%s %s bytes' % (encoding, size) for encoding, size in sorted(info['sizes'].items())
+            )))
+        self.stdout.write("Published version %s to %s in %.2fs" % (
+            manifest['version'], get_publish_root(), time.time() - start
+        ))
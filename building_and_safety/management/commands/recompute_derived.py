@@ -0,0 +1,53 @@
+import time
+from datetime import datetime
+from optparse import make_option
+from django.db import connection
+from building_and_safety.models import SourceFile, get_as_of_date
+from building_and_safety.derived import recompute_derived
+from building_and_safety.analysis import refresh_precomputed
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Recompute the derived complaint fields in the database against a new as-of date, without reloading."
+    option_list = BaseCommand.option_list + (
+        make_option('--as-of',
+            dest='as_of',
+            default=None,
+            help='Measure open complaints against this date, as YYYY-MM-DD. Defaults to the COMPLAINTS_AS_OF_DATE setting.'
+        ),
+        make_option('--all',
+            action='store_true',
+            dest='include_closed',
+            default=False,
+            help='Recompute closed complaints too, not just the open ones the as-of date affects.'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Recomputing derived fields in the database needs PostgreSQL.")
+
+        if options['as_of']:
+            try:
+                as_of = datetime.strptime(options['as_of'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("--as-of must be a date like 2014-07-13.")
+        else:
+            as_of = get_as_of_date()
+
+        if as_of != get_as_of_date():
+            self.stdout.write(
+                "%s isn't the COMPLAINTS_AS_OF_DATE setting, so the next load_complaints will measure against %s again."
+                % (as_of, get_as_of_date())
+            )
+
+        start = time.time()
+        count = recompute_derived(as_of, include_closed=options['include_closed'])
+        self.stdout.write("Recomputed %s complaints as of %s in %.2fs" % (count, as_of, time.time() - start))
+        # So the pages show the date the numbers were actually measured against
+        SourceFile.objects.update(as_of=as_of)
+
+        start = time.time()
+        refresh_precomputed()
+        self.stdout.write("Refreshed precomputed summaries in %.2fs" % (time.time() - start))
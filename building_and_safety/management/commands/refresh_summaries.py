@@ -0,0 +1,12 @@
+import time
+from building_and_safety.analysis import refresh_precomputed
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    help = "Rebuild the survival histograms and precomputed complaint summaries the analysis pages read from."
+
+    def handle(self, *args, **options):
+        start = time.time()
+        refresh_precomputed()
+        self.stdout.write("Refreshed precomputed summaries in %.2fs" % (time.time() - start))
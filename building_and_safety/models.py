@@ -1,15 +1,34 @@
 import json
 import logging
 import calculate
-from datetime import datetime
-from django.db import models
-from django.db.models import Avg
+from datetime import date
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Avg, Count, F
+from django.db.models.signals import pre_save, post_save
+from django.dispatch import receiver
 from django.utils import dateformat
 
 from lifelines import KaplanMeierFitter
 
 logger = logging.getLogger(__name__)
 
+# The day the data was pulled from the LADBS database.
+# Open complaints are measured against it unless settings say otherwise.
+MOST_RECENT_DATE = date(2014, 7, 13)
+
+
+def get_as_of_date():
+    """
+    The date open complaints are measured against, from the COMPLAINTS_AS_OF_DATE setting.
+    A setting of None means today.
+    """
+    as_of = getattr(settings, 'COMPLAINTS_AS_OF_DATE', MOST_RECENT_DATE)
+    return as_of or date.today()
+
+# The city's seven Area Planning Commissions
+REGION_NAMES = ['Central', 'East Los Angeles', 'Harbor', 'North Valley', 'South Los Angeles', 'South Valley', 'West Los Angeles']
+
 
 # Get the average wait time using a Kaplan-Meier Survival analysis estimate
 # Make arrays of the days since complaint, and whether a case is 'closed'
@@ -24,6 +43,25 @@ def get_kmf_fit(qs):
 def get_kmf_median(kmf):
     return kmf.median_
 
+
+# The fields that come straight from the LADBS data,
+# the ones we derive from them, and the ones reporters fill out by hand.
+RAW_FIELDS = (
+    'csr', 'ladbs_inspection_district', 'address_house_number', 'address_house_fraction',
+    'address_street_direction', 'address_street_name', 'address_street_suffix',
+    'address_street_suffix_direction', 'address_street_zip', 'date_received', 'date_closed',
+    'date_due', 'case_flag', 'csr_priority', 'gis_pin', 'csr_problem_type',
+    'area_planning_commission', 'case_number_csr', 'response_days', 'lat', 'lon',
+)
+DERIVED_FIELDS = (
+    'full_address', 'is_closed', 'gt_30_days', 'gt_90_days', 'gt_180_days', 'more_than_one_year',
+    'days_since_complaint', 'past_due_date', 'days_past_due_date', 'in_la_city', 'apc_assigned', 'resolved_apc',
+)
+MANUAL_FIELDS = (
+    'inspector', 'inspector_phone_number', 'notes', 'lat_visited', 'investigate_further',
+    'housing_dept_related',
+)
+
 class Complaint(models.Model):
     """
     A list of complaints filed to the L.A. Department of Building and Safety
@@ -61,6 +99,12 @@ class Complaint(models.Model):
         help_text="Days since the complaint was filed or days since filed until it was addressed.")
     past_due_date = models.BooleanField(default=False)
     days_past_due_date = models.IntegerField(null=True)
+    in_la_city = models.NullBooleanField(db_index=True, verbose_name="Inside the city limits",
+        help_text="Whether the complaint's location is inside the city boundary. Blank if it has no location.")
+    apc_assigned = models.CharField(max_length=255, blank=True, null=True, db_index=True,
+        verbose_name="APC from location", help_text="The Area Planning Commission the complaint's location falls in.")
+    resolved_apc = models.CharField(max_length=20, blank=True, null=True, db_index=True, verbose_name="APC",
+        help_text="The APC from the CSV if it's one we know, otherwise the one from the location. The per-region numbers use this.")
 
     # Fields to fill out manually
     inspector = models.CharField(max_length=255, blank=True, null=True)
@@ -75,6 +119,8 @@ class Complaint(models.Model):
 
     class Meta:
         ordering = ("-date_received",)
+        # So the complaints API can page through newest first with an index scan
+        index_together = [['date_received', 'id']]
 
     def __unicode__(self):
         return unicode(self.csr)
@@ -98,13 +144,12 @@ class Complaint(models.Model):
     def get_days_since_complaint(self):
         """
         Calculate the days since a complaint was filed and when it was addressed.
-        If a complaint is still unaddressed, use the date the data was pulled from the DB. 
+        If a complaint is still unaddressed, use the as-of date, usually when the data was pulled from the DB.
         """
-        most_recent_date = datetime.strptime("7/13/2014", "%m/%d/%Y").date()
         if self.date_closed:
             t = self.date_closed - self.date_received
         else:
-            t = most_recent_date - self.date_received
+            t = get_as_of_date() - self.date_received
 
         return t.days
 
@@ -114,11 +159,10 @@ class Complaint(models.Model):
         return False
 
     def get_days_past_due(self):
-        most_recent_date = datetime.strptime("7/13/2014", "%m/%d/%Y").date()
         if self.date_closed:
             t = self.date_closed - self.date_due
         else:
-            t = most_recent_date - self.date_due
+            t = get_as_of_date() - self.date_due
 
         if t.days > 0:
             return True, t.days
@@ -148,3 +192,179 @@ class Complaint(models.Model):
             }
         }
         return as_dict
+
+
+class SourceFile(models.Model):
+    """
+    A fingerprint of each LADBS CSV from the last time it was loaded successfully,
+    so we can tell when a file hasn't changed and skip loading it again.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    sha1 = models.CharField(max_length=40, help_text='Hash of the file contents')
+    row_count = models.IntegerField()
+    loaded = models.DateTimeField(auto_now=True)
+    as_of = models.DateField(null=True, help_text='The date open complaints were measured against')
+
+    def __unicode__(self):
+        return self.name
+
+
+def get_loaded_as_of_date():
+    """
+    The date the complaints in the database were actually measured against,
+    as of the last load or recompute_derived. Before anything's been loaded, it's the setting.
+    """
+    as_of = SourceFile.objects.exclude(as_of=None).order_by('-loaded').values_list('as_of', flat=True).first()
+    return as_of or get_as_of_date()
+
+
+class ComplaintSummary(models.Model):
+    """
+    Precomputed counts and Kaplan-Meier medians for one slice of the complaints,
+    refreshed each time the complaints are loaded.
+
+    A blank region or priority means "all of them", and a null is_closed
+    means open and closed complaints together. Region-level rows only count
+    complaints with a sensible days_since_complaint, like the analysis page always has.
+    """
+    region = models.CharField(max_length=20, blank=True)
+    priority = models.CharField(max_length=1, blank=True)
+    is_closed = models.NullBooleanField()
+    total = models.IntegerField(default=0)
+    gt_30_days = models.IntegerField(default=0)
+    gt_90_days = models.IntegerField(default=0)
+    gt_180_days = models.IntegerField(default=0)
+    more_than_one_year = models.IntegerField(default=0)
+    median_wait_kmf = models.FloatField(null=True, help_text="Only filled in when is_closed is null")
+    complaints_per_year = models.FloatField(null=True, help_text="Only filled in for a whole region")
+
+    class Meta:
+        unique_together = ('region', 'priority', 'is_closed')
+
+    def __unicode__(self):
+        return u'%s / %s / %s' % (self.region or 'All regions', self.priority or 'All priorities', self.is_closed)
+
+
+class ComplaintTypeSummary(models.Model):
+    """
+    Precomputed counts of each type of complaint in each region.
+    A blank priority means every priority level.
+    """
+    region = models.CharField(max_length=20, blank=True)
+    priority = models.CharField(max_length=1, blank=True)
+    csr_problem_type = models.CharField(max_length=255, blank=True, null=True)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        ordering = ('region', 'priority', '-count')
+        index_together = (('region', 'priority'),)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.region, self.csr_problem_type)
+
+
+class SurvivalHistogramManager(models.Manager):
+
+    def rebuild(self):
+        """
+        Recount every bin from scratch with one grouped query.
+        """
+        qs = Complaint.objects.filter(days_since_complaint__gte=0)\
+            .values('resolved_apc', 'csr_priority', 'days_since_complaint', 'is_closed')\
+            .annotate(count=Count('id')).order_by()
+        bins = {}
+        for row in qs:
+            key = (row['resolved_apc'] or '', row['csr_priority'] or '', row['days_since_complaint'])
+            counts = bins.setdefault(key, [0, 0])
+            counts[0 if row['is_closed'] else 1] += row['count']
+
+        with transaction.atomic():
+            self.all().delete()
+            self.bulk_create([
+                SurvivalHistogram(region=region, priority=priority, days=days, events=events, censored=censored)
+                for (region, priority, days), (events, censored) in bins.items()
+            ], batch_size=1000)
+        return len(bins)
+
+    def apply_changes(self, removed=(), added=()):
+        """
+        Update the bins for complaints that went away or changed, and ones that arrived.
+        Each observation is a (region, priority, days_since_complaint, is_closed) tuple.
+        Only the bins that actually move are touched.
+        """
+        deltas = {}
+        for sign, observations in ((-1, removed), (1, added)):
+            for region, priority, days, is_closed in observations:
+                if days is None or days < 0:
+                    continue
+                priority = unicode(priority) if priority is not None else ''
+                counts = deltas.setdefault((region or '', priority, days), [0, 0])
+                counts[0 if is_closed else 1] += sign
+
+        with transaction.atomic():
+            for (region, priority, days), (events, censored) in deltas.items():
+                if not events and not censored:
+                    continue
+                updated = self.filter(region=region, priority=priority, days=days)\
+                    .update(events=F('events') + events, censored=F('censored') + censored)
+                if not updated:
+                    self.create(region=region, priority=priority, days=days, events=events, censored=censored)
+            self.filter(events__lte=0, censored__lte=0).delete()
+        return len(deltas)
+
+
+class SurvivalHistogram(models.Model):
+    """
+    How many complaints in a region and priority level were closed (events)
+    or were still open (censored) a given number of days after they were filed.
+    It's all Kaplan-Meier needs, and it's kept up to date as complaints change.
+
+    A blank region or priority stands for a complaint that didn't have one.
+    """
+    region = models.CharField(max_length=20, blank=True)
+    priority = models.CharField(max_length=1, blank=True)
+    days = models.IntegerField()
+    events = models.IntegerField(default=0)
+    censored = models.IntegerField(default=0)
+
+    objects = SurvivalHistogramManager()
+
+    class Meta:
+        unique_together = ('region', 'priority', 'days')
+
+    def __unicode__(self):
+        return u'%s / %s / %s days' % (self.region, self.priority, self.days)
+
+
+def get_histogram_observation(complaint):
+    return (complaint.resolved_apc, complaint.csr_priority,
+        complaint.days_since_complaint, complaint.is_closed)
+
+
+@receiver(pre_save, sender=Complaint)
+def remember_histogram_observation(sender, instance, raw=False, **kwargs):
+    """
+    Hang on to how a complaint looked before it's saved, so we can move it to its new bin.
+    """
+    instance._old_observation = None
+    if instance.pk and not raw:
+        instance._old_observation = Complaint.objects.filter(pk=instance.pk).values_list(
+            'resolved_apc', 'csr_priority', 'days_since_complaint', 'is_closed'
+        ).first()
+
+
+@receiver(post_save, sender=Complaint)
+def update_survival_histogram(sender, instance, created, raw=False, **kwargs):
+    """
+    Keep the survival histograms in step when a single complaint is saved, say from the admin.
+    Bulk loads skip signals and update the histograms themselves.
+
+    Only the histograms move. The ComplaintSummary medians and counts the analysis page
+    shows stay as they were until the next refresh_precomputed, which the next load runs.
+    """
+    if raw:
+        return
+    old = getattr(instance, '_old_observation', None)
+    new = get_histogram_observation(instance)
+    if old != new:
+        SurvivalHistogram.objects.apply_changes([old] if old else [], [new])
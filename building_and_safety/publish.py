@@ -0,0 +1,167 @@
+"""
+Publish the map's complaints as files on disk, in GeoJSON and the compact format,
+built once per data version and compressed ahead of time, so the API views just hand them out.
+
+Every publish goes in a fresh directory, along with a manifest of the
+data version and each file's ETag and sizes. A pointer file names the
+directory being served and is swapped in only once everything is written,
+so readers never see a half-published version.
+
+Brotli copies are written too if the brotli module is installed.
+"""
+import os
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import logging
+from django.conf import settings
+from building_and_safety.caching import get_data_version
+from building_and_safety.geojson import GEOJSON_FIELDS, iter_queryset_geojson
+from building_and_safety.compact import encode_compact
+from building_and_safety.tiles import get_map_complaints
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# Each published file, whether it holds the closed complaints or the open ones,
+# and whether it's in the compact format rather than GeoJSON
+ARTIFACTS = (
+    ('complaints', False, False),
+    ('closed_complaints', True, False),
+    ('complaints.compact', False, True),
+    ('closed_complaints.compact', True, True),
+)
+
+# The file naming the directory currently being served
+CURRENT_FILE = 'current'
+MANIFEST_FILE = 'manifest.json'
+
+# How many published directories to keep around, so a request
+# that started on the last one can still finish
+KEEP_VERSIONS = 2
+
+# The Content-Encoding each compressed copy is served with, and its file extension
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def get_publish_root():
+    return getattr(settings, 'COMPLAINTS_PUBLISH_ROOT',
+        os.path.join(settings.ROOT_DIR, 'building_and_safety', 'data', 'published'))
+
+
+def write_atomic(path, data):
+    """
+    Write a file under a temporary name and rename it into place.
+    """
+    tmp = '%s.tmp' % path
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, path)
+
+
+def publish_artifact(directory, name, is_closed, compact=False):
+    """
+    Write one collection of complaints to disk, plain and compressed, and describe it for the manifest.
+    """
+    path = os.path.join(directory, '%s.json' % name)
+    complaints = get_map_complaints().filter(is_closed=is_closed)
+    if compact:
+        chunks = [json.dumps(encode_compact(complaints.order_by().values_list(*GEOJSON_FIELDS)))]
+    else:
+        chunks = iter_queryset_geojson(complaints)
+    sha1 = hashlib.sha1()
+    with open(path, 'wb') as f:
+        for chunk in chunks:
+            chunk = chunk.encode('utf-8') if isinstance(chunk, unicode) else chunk
+            sha1.update(chunk)
+            f.write(chunk)
+
+    info = {'etag': sha1.hexdigest(), 'sizes': {'identity': os.path.getsize(path)}}
+    with open(path, 'rb') as f_in:
+        with open(path + '.gz', 'wb') as raw:
+            # A fixed mtime keeps the gzip bytes the same for the same data
+            with gzip.GzipFile(filename='', mode='wb', compresslevel=9, fileobj=raw, mtime=0) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+    info['sizes']['gzip'] = os.path.getsize(path + '.gz')
+    if brotli is not None:
+        with open(path, 'rb') as f_in:
+            with open(path + '.br', 'wb') as f_out:
+                f_out.write(brotli.compress(f_in.read()))
+        info['sizes']['br'] = os.path.getsize(path + '.br')
+    return info
+
+
+def publish(version=None):
+    """
+    Write every artifact for a data version into a new directory, then start serving it.
+    Directories beyond the last KEEP_VERSIONS are removed.
+    """
+    root = get_publish_root()
+    published = time.time()
+    # Never write into the directory being served, even when republishing the same version
+    name = str(int(published * 1000))
+    directory = os.path.join(root, name)
+    os.makedirs(directory)
+
+    manifest = {
+        'version': version or get_data_version(),
+        'directory': name,
+        'published': int(published),
+        'artifacts': {},
+    }
+    for artifact, is_closed, compact in ARTIFACTS:
+        manifest['artifacts'][artifact] = publish_artifact(directory, artifact, is_closed, compact)
+    write_atomic(os.path.join(directory, MANIFEST_FILE), json.dumps(manifest))
+    write_atomic(os.path.join(root, CURRENT_FILE), name)
+
+    directories = sorted((d for d in os.listdir(root) if d.isdigit()), key=int)
+    for old in directories[:-KEEP_VERSIONS]:
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+    logger.debug("Published complaint artifacts for version %s to %s" % (manifest['version'], directory))
+    return manifest
+
+
+_manifest = {'directory': None, 'manifest': None}
+
+
+def get_current_manifest():
+    """
+    The manifest of the directory being served, or None if nothing has been published.
+    It's only read from disk again when the pointer file names a new directory.
+    """
+    root = get_publish_root()
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as f:
+            directory = f.read().strip()
+    except IOError:
+        return None
+    if _manifest['directory'] != directory:
+        try:
+            with open(os.path.join(root, directory, MANIFEST_FILE)) as f:
+                _manifest['manifest'] = json.load(f)
+        except IOError:
+            return None
+        _manifest['directory'] = directory
+    return _manifest['manifest']
+
+
+def get_artifact(name):
+    """
+    Where a published artifact lives and what to serve it with, or None if it isn't published.
+    """
+    manifest = get_current_manifest()
+    if manifest is None or name not in manifest['artifacts']:
+        return None
+    info = manifest['artifacts'][name]
+    path = os.path.join(get_publish_root(), manifest['directory'], '%s.json' % name)
+    return {
+        'path': path,
+        'etag': info['etag'],
+        'sizes': info['sizes'],
+        'last_modified': manifest['published'],
+    }
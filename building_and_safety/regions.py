@@ -0,0 +1,224 @@
+"""
+Work out which polygons each complaint falls in: the city boundary,
+the Area Planning Commissions and any other layer listed in the
+COMPLAINTS_POLYGON_LAYERS setting.
+
+Each layer is a GeoJSON file of polygons that fills one Complaint field.
+If the layer names a label property, the field gets the label of the polygon
+the complaint is in. Otherwise it's a yes or no.
+
+The point-in-polygon test is the even-odd rule, run over NumPy arrays:
+points are first narrowed down to each polygon's bounding box, then every
+edge of the polygon is tested against all the remaining points at once.
+"""
+import os
+import json
+import logging
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from building_and_safety.models import Complaint, REGION_NAMES
+
+logger = logging.getLogger(__name__)
+
+# The field holding the APC worked out from a complaint's location,
+# which stands in for a missing or unrecognized one from the CSV
+REGION_FIELD = 'apc_assigned'
+
+# The field the per-region numbers use. The CSV's own APC column is never overwritten.
+RESOLVED_FIELD = 'resolved_apc'
+
+# The most points times edges we'll test in one broadcast. Bigger jobs
+# sort the points and only test each edge against the points level with it.
+BROADCAST_LIMIT = 1000000
+
+# How many complaints each UPDATE in reassign_regions touches
+UPDATE_BATCH_SIZE = 5000
+
+
+class Polygon(object):
+    """
+    One polygon, holes and all, as flat arrays of its edges.
+    """
+    def __init__(self, rings, label=None):
+        self.label = label
+        starts, ends = [], []
+        for ring in rings:
+            ring = np.asarray(ring, dtype=float)[:, :2]
+            if len(ring) and (ring[0] != ring[-1]).any():
+                ring = np.vstack([ring, ring[:1]])
+            starts.append(ring[:-1])
+            ends.append(ring[1:])
+        starts, ends = np.vstack(starts), np.vstack(ends)
+        self.x1, self.y1 = starts[:, 0], starts[:, 1]
+        self.x2, self.y2 = ends[:, 0], ends[:, 1]
+        self.ymin = np.minimum(self.y1, self.y2)
+        self.ymax = np.maximum(self.y1, self.y2)
+        # How far x moves for each step in y along each edge. Flat edges never cross a ray.
+        dy = self.y2 - self.y1
+        self.slope = np.where(dy != 0, (self.x2 - self.x1) / np.where(dy != 0, dy, 1), 0)
+        self.bbox = (starts[:, 0].min(), starts[:, 1].min(), starts[:, 0].max(), starts[:, 1].max())
+
+    def __len__(self):
+        return len(self.x1)
+
+    def in_bbox(self, x, y):
+        west, south, east, north = self.bbox
+        return (x >= west) & (x <= east) & (y >= south) & (y <= north)
+
+    def contains(self, x, y):
+        """
+        Whether each point is inside, by counting the edges a ray from it to the right crosses.
+        An edge crosses when the point's y falls in [min(y1, y2), max(y1, y2)).
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        if len(x) * len(self) <= BROADCAST_LIMIT:
+            xs, ys = x[:, np.newaxis], y[:, np.newaxis]
+            crosses = (self.ymin <= ys) & (ys < self.ymax)
+            hits = crosses & (xs < self.x1 + (ys - self.y1) * self.slope)
+            return hits.sum(axis=1) % 2 == 1
+
+        # Sorted by y, the points level with an edge are one slice
+        order = np.argsort(y, kind='mergesort')
+        xs, ys = x[order], y[order]
+        lo = np.searchsorted(ys, self.ymin, side='left')
+        hi = np.searchsorted(ys, self.ymax, side='left')
+        inside = np.zeros(len(x), dtype=bool)
+        for e in np.flatnonzero(hi > lo):
+            s = slice(lo[e], hi[e])
+            inside[s] ^= xs[s] < self.x1[e] + (ys[s] - self.y1[e]) * self.slope[e]
+        result = np.empty(len(x), dtype=bool)
+        result[order] = inside
+        return result
+
+
+class PolygonLayer(object):
+    """
+    Every polygon in a GeoJSON file, and the Complaint field they fill.
+    """
+    def __init__(self, field, collection, label_property=None):
+        self.field = field
+        self.label_property = label_property
+        self.polygons = []
+        for feature in collection['features']:
+            geometry = feature['geometry']
+            label = feature['properties'].get(label_property) if label_property else True
+            if geometry['type'] == 'Polygon':
+                parts = [geometry['coordinates']]
+            elif geometry['type'] == 'MultiPolygon':
+                parts = geometry['coordinates']
+            else:
+                continue
+            self.polygons.extend(Polygon(rings, label) for rings in parts if rings)
+
+    @classmethod
+    def from_file(cls, field, path, label_property=None):
+        with open(path) as f:
+            return cls(field, json.load(f), label_property)
+
+    def classify(self, x, y):
+        """
+        The label of the first polygon each point falls in, or the default for points outside them all:
+        None for a labeled layer and False for a yes or no one.
+        """
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        found = np.zeros(len(x), dtype=np.int64) - 1
+        for i, polygon in enumerate(self.polygons):
+            candidates = np.flatnonzero((found < 0) & polygon.in_bbox(x, y))
+            if len(candidates):
+                found[candidates[polygon.contains(x[candidates], y[candidates])]] = i
+        default = None if self.label_property else False
+        return [self.polygons[i].label if i >= 0 else default for i in found.tolist()]
+
+
+_layers = {}
+
+
+def get_layers():
+    """
+    The polygon layers from the COMPLAINTS_POLYGON_LAYERS setting, read from disk once per process.
+    Layers whose file is missing are skipped.
+    """
+    layers = []
+    for config in getattr(settings, 'COMPLAINTS_POLYGON_LAYERS', ()):
+        path = config['path']
+        if path not in _layers:
+            if not os.path.exists(path):
+                logger.debug("Skipping the %s polygon layer, %s doesn't exist" % (config['field'], path))
+                _layers[path] = None
+            else:
+                _layers[path] = PolygonLayer.from_file(config['field'], path, config.get('property'))
+        if _layers[path] is not None:
+            layers.append(_layers[path])
+    return layers
+
+
+def fill_region(complaint):
+    """
+    Settle which APC a complaint counts toward: the CSV's if we recognize it,
+    otherwise the one worked out from the location, otherwise none.
+    """
+    resolved = None
+    if complaint.area_planning_commission in REGION_NAMES:
+        resolved = complaint.area_planning_commission
+    elif getattr(complaint, REGION_FIELD, None) in REGION_NAMES:
+        resolved = getattr(complaint, REGION_FIELD)
+    setattr(complaint, RESOLVED_FIELD, resolved)
+
+
+def assign_regions(complaints):
+    """
+    Fill in the polygon layer fields on a list of unsaved Complaint objects,
+    and settle the APC each one counts toward.
+    """
+    located = [c for c in complaints if c.lat is not None and c.lon is not None]
+    if located:
+        x = [c.lon for c in located]
+        y = [c.lat for c in located]
+        for layer in get_layers():
+            for c, value in zip(located, layer.classify(x, y)):
+                setattr(c, layer.field, value)
+    for c in complaints:
+        fill_region(c)
+    return complaints
+
+
+def reassign_regions():
+    """
+    Classify every complaint already in the database against the current layers,
+    then settle the APC each one counts toward. Complaints that share an answer
+    are updated together, UPDATE_BATCH_SIZE at a time, rather than one by one.
+
+    Returns the number of complaints classified.
+    """
+    layers = get_layers()
+    rows = list(Complaint.objects.exclude(lat=None).exclude(lon=None).order_by().values_list('id', 'lon', 'lat'))
+    groups = {}
+    if layers and rows:
+        ids, x, y = zip(*rows)
+        columns = [layer.classify(x, y) for layer in layers]
+        for pk, values in zip(ids, zip(*columns)):
+            groups.setdefault(values, []).append(pk)
+    fields = [layer.field for layer in layers]
+
+    with transaction.atomic():
+        for values, pks in groups.items():
+            for i in range(0, len(pks), UPDATE_BATCH_SIZE):
+                Complaint.objects.filter(pk__in=pks[i:i + UPDATE_BATCH_SIZE]).update(**dict(zip(fields, values)))
+        # The same rule as fill_region, for every row in one statement
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE %(table)s SET %(resolved)s = COALESCE(
+                CASE WHEN %(apc)s IN %%s THEN %(apc)s END,
+                CASE WHEN %(assigned)s IN %%s THEN %(assigned)s END
+            )
+        """ % {
+            'table': qn(Complaint._meta.db_table),
+            'resolved': qn(RESOLVED_FIELD),
+            'apc': qn('area_planning_commission'),
+            'assigned': qn(REGION_FIELD),
+        }, [tuple(REGION_NAMES), tuple(REGION_NAMES)])
+    return len(rows)
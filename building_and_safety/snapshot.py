@@ -0,0 +1,178 @@
+"""
+A columnar, on-disk snapshot of the Complaint table.
+
+Each field gets its own .npy file, so the snapshot can be memory-mapped
+straight back into NumPy and pandas without going through the ORM.
+A handful of short, repetitive text fields are dictionary-encoded:
+they're stored as integer codes plus a JSON list of the distinct values.
+
+    >>> from building_and_safety.snapshot import load_snapshot
+    >>> df = load_snapshot('/path/to/snapshot')
+"""
+import os
+import json
+import numpy as np
+import pandas as pd
+from itertools import islice
+from django.db import connection, models
+
+# Text fields stored as integer codes into a list of distinct values
+DICTIONARY_FIELDS = ('area_planning_commission', 'apc_assigned', 'resolved_apc', 'csr_problem_type', 'csr_priority')
+
+# Text fields too long or too free-form to be worth storing
+SKIPPED_FIELDS = ('notes',)
+
+META_FILE = 'meta.json'
+
+
+def get_dtype(field):
+    """
+    The NumPy type we store a model field as.
+    Nullable integers and booleans become floats so they can hold NaN, the way pandas would have them anyway.
+    Dates are stored at nanosecond precision so pandas can use them as-is.
+    """
+    # NullBooleanField isn't a BooleanField, so it would otherwise be taken for text
+    if isinstance(field, models.NullBooleanField):
+        return np.dtype('float64')
+    if isinstance(field, models.BooleanField):
+        return np.dtype('bool')
+    if isinstance(field, (models.AutoField, models.IntegerField)):
+        return np.dtype('float64') if field.null else np.dtype('int64')
+    if isinstance(field, models.FloatField):
+        return np.dtype('float64')
+    if isinstance(field, models.DateField):
+        return np.dtype('datetime64[ns]')
+    return None
+
+
+def to_storage(value, dtype):
+    """
+    Convert a value from the database into something a typed array will accept.
+    """
+    if value is None:
+        if dtype.kind == 'M':
+            return np.datetime64('NaT')
+        return np.nan
+    if dtype.kind == 'M':
+        return np.datetime64(value.isoformat(), 'ns')
+    return value
+
+
+def get_text_width(model, field):
+    """
+    The length of the longest value in a text column, so fixed-width arrays aren't padded out to max_length.
+    """
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute("SELECT MAX(LENGTH(%s)) FROM %s" % (qn(field.column), qn(model._meta.db_table)))
+    return max(cursor.fetchone()[0] or 1, 1)
+
+
+def write_snapshot(model, path, chunk_size=10000):
+    """
+    Write every row of a model's table to a directory of .npy files, one per field.
+
+    Arrays are allocated on disk with open_memmap and filled a chunk at a time,
+    so even a big table never has to fit in memory all at once.
+    Null text is stored as an empty string.
+    """
+    queryset = model.objects.order_by('pk')
+    fields = [f for f in model._meta.local_fields if f.name not in SKIPPED_FIELDS]
+    count = queryset.count()
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    arrays, categories = {}, {}
+    for field in fields:
+        if field.name in DICTIONARY_FIELDS:
+            values = model.objects.order_by(field.attname).values_list(field.attname, flat=True).distinct()
+            categories[field.name] = [v for v in values if v is not None]
+            dtype = np.dtype('int32')
+        else:
+            dtype = get_dtype(field)
+            if dtype is None:
+                dtype = np.dtype('U%s' % get_text_width(model, field))
+        arrays[field.name] = np.lib.format.open_memmap(
+            os.path.join(path, '%s.npy' % field.name), mode='w+', dtype=dtype, shape=(count,)
+        )
+
+    # Missing values get the code -1, which pandas reads as NaN
+    lookups = dict(
+        (name, dict((value, i) for i, value in enumerate(values)))
+        for name, values in categories.items()
+    )
+    rows = queryset.values_list(*[f.attname for f in fields]).iterator()
+
+    # Rows added since we counted are left for the next snapshot
+    i = 0
+    while i < count:
+        chunk = list(islice(rows, min(chunk_size, count - i)))
+        if not chunk:
+            break
+        for j, field in enumerate(fields):
+            array = arrays[field.name]
+            column = [row[j] for row in chunk]
+            if field.name in lookups:
+                lookup = lookups[field.name]
+                array[i:i + len(chunk)] = [lookup.get(v, -1) for v in column]
+            elif array.dtype.kind == 'U':
+                array[i:i + len(chunk)] = [v or u'' for v in column]
+            else:
+                array[i:i + len(chunk)] = [to_storage(v, array.dtype) for v in column]
+        i += len(chunk)
+
+    for array in arrays.values():
+        array.flush()
+
+    meta = {
+        'model': '%s.%s' % (model._meta.app_label, model._meta.object_name),
+        'count': i,
+        'fields': [f.name for f in fields],
+        'categories': categories,
+    }
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def load_snapshot_arrays(path):
+    """
+    Memory-map every column of a snapshot. Nothing is read from disk until it's used.
+    Returns the snapshot's metadata and a dict of field name to read-only array.
+    """
+    with open(os.path.join(path, META_FILE)) as f:
+        meta = json.load(f)
+    arrays = dict(
+        (name, np.load(os.path.join(path, '%s.npy' % name), mmap_mode='r'))
+        for name in meta['fields']
+    )
+    return meta, arrays
+
+
+def make_categorical(codes, categories):
+    """
+    Wrap integer codes and their values in a pandas Categorical without decoding them.
+    Newer pandas spells this from_codes; older versions take the codes as labels.
+    """
+    if hasattr(pd.Categorical, 'from_codes'):
+        return pd.Categorical.from_codes(codes, categories)
+    return pd.Categorical(codes, levels=categories)
+
+
+def load_snapshot(path):
+    """
+    Load a snapshot into a DataFrame built on the memory-mapped columns.
+    Dictionary-encoded fields come back as categoricals without decoding their strings.
+
+    pandas may still consolidate columns of the same type into one block when it
+    builds the frame. If you need a guarantee that nothing is copied,
+    use load_snapshot_arrays instead.
+    """
+    meta, arrays = load_snapshot_arrays(path)
+    columns = {}
+    for name in meta['fields']:
+        if name in meta['categories']:
+            columns[name] = make_categorical(arrays[name], meta['categories'][name])
+        else:
+            columns[name] = arrays[name]
+    return pd.DataFrame(columns, columns=meta['fields'], copy=False)
@@ -0,0 +1,144 @@
+"""
+An in-memory spatial index of the complaints on the map, for bounding box
+and radius queries that never touch the database.
+
+Points are bucketed into a uniform grid of square cells and sorted by cell,
+so every row of cells a query covers is one contiguous slice of the arrays,
+found with a binary search. The candidates are then checked exactly.
+
+Each process builds the index the first time it's needed,
+and again whenever the data version moves on.
+"""
+import math
+import threading
+import numpy as np
+from building_and_safety.caching import get_data_version
+from building_and_safety.geojson import GEOJSON_FIELDS
+from building_and_safety.tiles import get_map_complaints
+
+# The width of a grid cell in degrees, about a kilometer in Los Angeles
+CELL_SIZE = 0.01
+
+# The radius of a ?near= query when none is given, and the largest we'll search, in meters
+DEFAULT_RADIUS = 500
+MAX_RADIUS = 50000
+
+EARTH_RADIUS_METERS = 6371008.8
+METERS_PER_DEGREE = 111320.0
+
+
+class SpatialIndex(object):
+    """
+    A uniform grid over a list of GEOJSON_FIELDS rows, which start with lon and lat.
+    Queries return the matching rows.
+    """
+    def __init__(self, rows, is_closed=None, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        lon = np.array([r[0] for r in rows], dtype=float)
+        lat = np.array([r[1] for r in rows], dtype=float)
+        if is_closed is None:
+            is_closed = [False] * len(rows)
+        is_closed = np.array(is_closed, dtype=bool)
+
+        if len(rows):
+            self.west, self.south = lon.min(), lat.min()
+            cols = self.get_cells(lon, self.west)
+            lat_cells = self.get_cells(lat, self.south)
+            self.ncols = int(cols.max()) + 1
+            self.nrows = int(lat_cells.max()) + 1
+        else:
+            self.west = self.south = 0.0
+            cols = lat_cells = np.zeros(0, dtype=np.int64)
+            self.ncols = self.nrows = 1
+
+        cells = lat_cells * self.ncols + cols
+        order = np.argsort(cells, kind='mergesort')
+        self.cells = cells[order]
+        self.lon = lon[order]
+        self.lat = lat[order]
+        self.is_closed = is_closed[order]
+        self.rows = [rows[i] for i in order]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get_cells(self, values, origin):
+        return np.floor((np.asarray(values, dtype=float) - origin) / self.cell_size).astype(np.int64)
+
+    def get_candidates(self, west, south, east, north):
+        """
+        Positions of every point in the grid cells a box touches.
+        """
+        if not len(self) or west > east or south > north:
+            return np.zeros(0, dtype=np.int64)
+        c0, c1 = np.clip(self.get_cells([west, east], self.west), 0, self.ncols - 1)
+        r0, r1 = np.clip(self.get_cells([south, north], self.south), 0, self.nrows - 1)
+        # Each row of cells from c0 to c1 is one run of the sorted cell numbers
+        grid_rows = np.arange(r0, r1 + 1)
+        starts = np.searchsorted(self.cells, grid_rows * self.ncols + c0, side='left')
+        ends = np.searchsorted(self.cells, grid_rows * self.ncols + c1, side='right')
+        if not len(starts):
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+
+    def filter(self, positions, is_closed=None):
+        if is_closed is not None:
+            positions = positions[self.is_closed[positions] == is_closed]
+        return [self.rows[i] for i in positions]
+
+    def bbox(self, west, south, east, north, is_closed=None):
+        """
+        The rows inside a box, edges included.
+        """
+        candidates = self.get_candidates(west, south, east, north)
+        lon, lat = self.lon[candidates], self.lat[candidates]
+        inside = (lon >= west) & (lon <= east) & (lat >= south) & (lat <= north)
+        return self.filter(candidates[inside], is_closed)
+
+    def near(self, lat, lon, radius, is_closed=None):
+        """
+        The rows within radius meters of a point, nearest first.
+        """
+        dlat = radius / METERS_PER_DEGREE
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        candidates = self.get_candidates(lon - dlon, lat - dlat, lon + dlon, lat + dlat)
+        distances = haversine(lat, lon, self.lat[candidates], self.lon[candidates])
+        inside = distances <= radius
+        candidates, distances = candidates[inside], distances[inside]
+        return self.filter(candidates[np.argsort(distances, kind='mergesort')], is_closed)
+
+
+def haversine(lat, lon, lats, lons):
+    """
+    Great-circle distances in meters from one point to arrays of others.
+    """
+    lat, lon = math.radians(lat), math.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + math.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+_index = {'version': None, 'index': None}
+_lock = threading.Lock()
+
+
+def build_spatial_index():
+    """
+    Read every complaint on the map once and index it.
+    """
+    rows = list(get_map_complaints().order_by().values_list(*(GEOJSON_FIELDS + ('is_closed',))))
+    return SpatialIndex([r[:-1] for r in rows], [r[-1] for r in rows])
+
+
+def get_spatial_index():
+    """
+    This process's index of the complaints on the map, rebuilt if the data has changed since.
+    """
+    version = get_data_version()
+    if _index['version'] != version:
+        with _lock:
+            # Another thread may have rebuilt it while we waited
+            if _index['version'] != version:
+                _index['index'] = build_spatial_index()
+                _index['version'] = version
+    return _index['index']
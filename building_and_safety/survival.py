@@ -0,0 +1,236 @@
+"""
+A Kaplan-Meier survival estimator built on NumPy.
+
+It gives the same survival curves and medians as lifelines' KaplanMeierFitter,
+but it can fit every stratum we care about from a single fetch of the data:
+rows are sorted once, collapsed into per-stratum histograms of
+(day, events, censored) and each curve is a cumulative product over its histogram.
+"""
+import numpy as np
+from itertools import groupby
+from building_and_safety.models import Complaint, SurvivalHistogram, REGION_NAMES
+
+PRIORITIES = ('1', '2', '3')
+
+# Fields the survival API can break complaints down by, and filter them on
+GROUP_BY_FIELDS = ('area_planning_commission', 'csr_priority', 'ladbs_inspection_district',
+    'csr_problem_type', 'address_street_zip', 'case_flag')
+FILTER_FIELDS = GROUP_BY_FIELDS + ('gt_30_days', 'gt_90_days', 'gt_180_days', 'more_than_one_year')
+
+# The days we report the share of complaints still open at
+SURVIVAL_DAYS = (30, 90, 180, 365)
+
+
+class KaplanMeier(object):
+    """
+    A fitted survival curve: the probability a complaint is still open
+    at each day on the timeline.
+    """
+    def __init__(self, timeline, survival):
+        self.timeline = timeline
+        self.survival = survival
+
+    @property
+    def median_(self):
+        """
+        The first day the survival curve reaches one half or less, as lifelines 0.4 defines it.
+        If it ends above one half, the median is infinite. An empty curve has no median.
+        """
+        if not len(self.survival):
+            return None
+        if self.survival[-1] > 0.5:
+            return np.inf
+        return float(self.timeline[np.flatnonzero(self.survival <= 0.5)[0]])
+
+    def predict(self, t):
+        """
+        The probability a complaint is still open after t days.
+        """
+        i = np.searchsorted(self.timeline, t, side='right') - 1
+        if i < 0:
+            return 1.0
+        return float(self.survival[i])
+
+
+class Histogram(object):
+    """
+    For each distinct day, how many complaints were closed that day (events)
+    and how many were still open when we last looked (censored).
+    That's everything Kaplan-Meier needs, in O(distinct days) space.
+    """
+    def __init__(self, days, events, censored):
+        self.days = np.asarray(days, dtype=float)
+        self.events = np.asarray(events, dtype=np.int64)
+        self.censored = np.asarray(censored, dtype=np.int64)
+
+    def __len__(self):
+        return int(self.events.sum() + self.censored.sum())
+
+    @classmethod
+    def from_observations(cls, durations, observed):
+        durations = np.asarray(durations, dtype=float)
+        observed = np.asarray(observed, dtype=np.int64)
+        days, inverse = np.unique(durations, return_inverse=True)
+        events = np.bincount(inverse, weights=observed, minlength=len(days)).astype(np.int64)
+        total = np.bincount(inverse, minlength=len(days))
+        return cls(days, events, total - events)
+
+    @classmethod
+    def merge(cls, histograms):
+        """
+        Combine several histograms into one, say every priority level within a region.
+        """
+        histograms = [h for h in histograms if len(h.days)]
+        if not histograms:
+            return cls([], [], [])
+        days, inverse = np.unique(np.concatenate([h.days for h in histograms]), return_inverse=True)
+        events = np.bincount(inverse, weights=np.concatenate([h.events for h in histograms]), minlength=len(days))
+        censored = np.bincount(inverse, weights=np.concatenate([h.censored for h in histograms]), minlength=len(days))
+        return cls(days, events.astype(np.int64), censored.astype(np.int64))
+
+    def fit(self):
+        """
+        S(t) is the product, over every day up to t, of the share of
+        complaints still open that made it through the day.
+        """
+        removed = self.events + self.censored
+        # Everyone whose day hasn't come yet is still at risk
+        at_risk = removed[::-1].cumsum()[::-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            survival = np.cumprod(1.0 - self.events / at_risk.astype(float))
+        return KaplanMeier(self.days, survival)
+
+
+def group_histograms(keys, durations, observed):
+    """
+    Build a histogram for every distinct key with one sort of all the rows.
+    Keys can be anything hashable, like a (region, priority) tuple.
+    """
+    codes_for = {}
+    codes = np.array([codes_for.setdefault(k, len(codes_for)) for k in keys], dtype=np.int64)
+    durations = np.asarray(durations, dtype=float)
+    observed = np.asarray(observed, dtype=np.int64)
+    if not len(codes):
+        return {}
+
+    order = np.lexsort((durations, codes))
+    codes, durations, observed = codes[order], durations[order], observed[order]
+
+    # Collapse runs of the same key and day into one histogram bin
+    change = np.empty(len(codes), dtype=bool)
+    change[0] = True
+    change[1:] = (codes[1:] != codes[:-1]) | (durations[1:] != durations[:-1])
+    starts = np.flatnonzero(change)
+    bin_codes = codes[starts]
+    bin_days = durations[starts]
+    bin_totals = np.diff(np.append(starts, len(codes)))
+    bin_events = np.add.reduceat(observed, starts)
+
+    # Then split the bins up by key
+    key_starts = np.flatnonzero(np.append(True, bin_codes[1:] != bin_codes[:-1]))
+    key_ends = np.append(key_starts[1:], len(bin_codes))
+    keys_for = dict((code, key) for key, code in codes_for.items())
+    histograms = {}
+    for start, end in zip(key_starts, key_ends):
+        events = bin_events[start:end]
+        histograms[keys_for[bin_codes[start]]] = Histogram(
+            bin_days[start:end], events, bin_totals[start:end] - events
+        )
+    return histograms
+
+
+def fit_groups(keys, durations, observed):
+    """
+    Fit a Kaplan-Meier curve for every distinct key.
+    """
+    return dict((key, h.fit()) for key, h in group_histograms(keys, durations, observed).items())
+
+
+def get_complaint_histograms(queryset=None):
+    """
+    Fetch every complaint with a sensible wait time once,
+    and bin it by region and priority level.
+    """
+    if queryset is None:
+        queryset = Complaint.objects.all()
+    rows = list(queryset.filter(days_since_complaint__gte=0).order_by().values_list(
+        'resolved_apc', 'csr_priority', 'days_since_complaint', 'is_closed'
+    ))
+    return group_histograms(
+        [(r[0], r[1]) for r in rows],
+        [r[2] for r in rows],
+        [r[3] for r in rows],
+    )
+
+
+def get_stored_histograms():
+    """
+    Read the histograms kept in the SurvivalHistogram table, keyed by (region, priority).
+    This costs O(distinct days) per stratum, however many complaints there are.
+    """
+    rows = SurvivalHistogram.objects.order_by('region', 'priority', 'days')\
+        .values_list('region', 'priority', 'days', 'events', 'censored')
+    histograms = {}
+    for (region, priority), bins in groupby(rows, key=lambda r: (r[0], r[1])):
+        bins = list(bins)
+        histograms[(region or None, priority or None)] = Histogram(
+            [b[2] for b in bins], [b[3] for b in bins], [b[4] for b in bins]
+        )
+    return histograms
+
+
+def fit_complaint_strata(queryset=None, histograms=None):
+    """
+    Kaplan-Meier curves for all complaints, each priority level, each region
+    and each priority level within each region, keyed by (region, priority).
+    None stands for "all" in either spot.
+
+    The finest strata are fit from the histograms of a single query,
+    and coarser ones by merging those histograms.
+    """
+    if histograms is None:
+        histograms = get_complaint_histograms(queryset)
+
+    def merged(region=None, priority=None):
+        return Histogram.merge([
+            h for (r, p), h in histograms.items()
+            if (region is None or r == region) and (priority is None or p == priority)
+        ])
+
+    strata = {}
+    for region in [None] + list(REGION_NAMES):
+        strata[(region, None)] = merged(region).fit()
+        for priority in PRIORITIES:
+            strata[(region, priority)] = merged(region, priority).fit()
+    return strata
+
+
+def survival_by_group(group_by, filters=None):
+    """
+    Median wait, the share of complaints still open at 30, 90, 180 and 365 days,
+    and a count for every combination of the group_by fields, from one query.
+
+    A median of None means the curve never got down to one half.
+    """
+    group_by = list(group_by)
+    queryset = Complaint.objects.filter(days_since_complaint__gte=0, **(filters or {}))
+    rows = list(queryset.order_by().values_list(*(group_by + ['days_since_complaint', 'is_closed'])))
+    n = len(group_by)
+    histograms = group_histograms(
+        [r[:n] for r in rows],
+        [r[n] for r in rows],
+        [r[n + 1] for r in rows],
+    )
+
+    results = []
+    for key, histogram in histograms.items():
+        km = histogram.fit()
+        median = km.median_
+        results.append({
+            'group': dict(zip(group_by, key)),
+            'count': len(histogram),
+            'median': median if median is not None and np.isfinite(median) else None,
+            'survival': dict((str(t), km.predict(t)) for t in SURVIVAL_DAYS),
+        })
+    results.sort(key=lambda r: -r['count'])
+    return results
@@ -1,3 +1,704 @@
+import json
+import shutil
+import tempfile
+import time
+import threading
+import numpy as np
+from unittest import skipUnless
+from datetime import date, timedelta
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.http import http_date
+from django.core.cache import get_cache
+from django.db.models import Count
+from building_and_safety.models import Complaint, SourceFile, SurvivalHistogram, MANUAL_FIELDS, REGION_NAMES, \
+    get_as_of_date, get_loaded_as_of_date, get_kmf_fit, get_kmf_median
+from building_and_safety.derived import derive_fields, derive_complaints, recompute_derived
+from building_and_safety.survival import fit_groups
+from building_and_safety.geojson import row_to_feature
+from building_and_safety.spatial import SpatialIndex, haversine
+from building_and_safety.compact import encode_compact, decode_compact
+from building_and_safety.tiles import tile_bounds, lonlat_to_pixels, build_tile, TILE_SIZE
+from building_and_safety import regions, caching, publish
+from building_and_safety.analysis import ComplaintCounts, AGE_FIELDS, refresh_summaries, get_summaries, get_top_types
+from building_and_safety.management.commands.load_complaints import Command as LoadComplaintsCommand
 
-# Create your tests here.
+
+class DerivedFieldsTest(TestCase):
+
+    def test_vectorized_matches_model_methods(self):
+        """
+        The batch derivation engine should give exactly the same answers
+        as the per-object methods on the Complaint model.
+        """
+        dates = [
+            # received, closed, due
+            (date(2011, 3, 1), None, date(2011, 3, 21)),
+            (date(2013, 6, 13), None, date(2014, 8, 1)),
+            (date(2014, 6, 13), None, None),
+            (date(2012, 1, 1), date(2012, 1, 31), date(2012, 1, 15)),
+            (date(2012, 1, 1), date(2012, 1, 1), date(2012, 1, 1)),
+            (date(2011, 5, 5), date(2013, 5, 6), None),
+            (date(2014, 7, 13), None, date(2014, 7, 13)),
+            (date(2013, 7, 13), None, date(2013, 7, 20)),
+        ]
+        complaints = []
+        for received, closed, due in dates:
+            c = Complaint(date_received=received, date_closed=closed, date_due=due)
+            c.is_closed = c.date_closed is not None
+            c.days_since_complaint = c.get_days_since_complaint()
+            c.more_than_one_year = c.get_gt_t_days(365)
+            c.gt_180_days = c.get_gt_t_days(180)
+            c.gt_90_days = c.get_gt_t_days(90)
+            c.gt_30_days = c.get_gt_t_days(30)
+            if c.date_due:
+                c.past_due_date, c.days_past_due_date = c.get_days_past_due()
+            complaints.append(c)
+
+        fields = derive_fields(*zip(*dates))
+        for i, c in enumerate(complaints):
+            for name, values in fields.items():
+                self.assertEqual(values[i], getattr(c, name), "%s differs for %s" % (name, dates[i]))
+                self.assertEqual(type(values[i]), type(getattr(c, name)))
+
+
+    def test_recompute_matches_derive_fields(self):
+        """
+        Recomputing in the database should give the same answers as deriving in NumPy for the same as-of date.
+        """
+        dates = [
+            # received, closed, due
+            (date(2011, 3, 1), None, date(2011, 3, 21)),
+            (date(2013, 6, 13), None, date(2014, 8, 1)),
+            (date(2014, 6, 13), None, None),
+            (None, None, date(2014, 1, 1)),
+            (date(2012, 1, 1), date(2012, 1, 31), date(2012, 1, 15)),
+            (date(2011, 5, 5), date(2013, 5, 6), None),
+        ]
+        before = derive_fields(*zip(*dates), as_of=date(2014, 7, 13))
+        Complaint.objects.bulk_create([
+            Complaint(csr=i, date_received=received, date_closed=closed, date_due=due, case_flag=False,
+                **dict((name, values[i]) for name, values in before.items()))
+            for i, (received, closed, due) in enumerate(dates)
+        ])
+
+        as_of = date(2015, 1, 1)
+        self.assertEqual(recompute_derived(as_of, include_closed=True), len(dates))
+        fields = derive_fields(*zip(*dates), as_of=as_of)
+        rows = Complaint.objects.order_by('csr').values_list('csr', *fields.keys())
+        for row in rows:
+            for name, value in zip(fields.keys(), row[1:]):
+                self.assertEqual(value, fields[name][row[0]], "%s differs for %s" % (name, dates[row[0]]))
+
+
+class AsOfDateTest(TestCase):
+
+    def test_loaded_as_of_date(self):
+        """
+        The pages should show the date the data was measured against, not whatever the setting says now.
+        """
+        self.assertEqual(get_loaded_as_of_date(), get_as_of_date())
+        SourceFile.objects.create(name='complaints.csv', sha1='0' * 40, row_count=1, as_of=date(2013, 1, 1))
+        self.assertEqual(get_loaded_as_of_date(), date(2013, 1, 1))
+        SourceFile.objects.update(as_of=date(2012, 6, 30))
+        self.assertEqual(get_loaded_as_of_date(), date(2012, 6, 30))
+
+
+class SurvivalTest(TestCase):
+
+    def test_matches_lifelines(self):
+        """
+        The NumPy Kaplan-Meier engine should match lifelines curve for curve.
+        """
+        from lifelines import KaplanMeierFitter
+        random = np.random.RandomState(0)
+        durations = random.randint(0, 400, size=3000)
+        observed = random.rand(3000) < 0.7
+        keys = random.randint(0, 4, size=3000)
+
+        fits = fit_groups(keys.tolist(), durations, observed)
+        self.assertEqual(sorted(fits.keys()), [0, 1, 2, 3])
+        for key, km in fits.items():
+            mask = keys == key
+            kmf = KaplanMeierFitter()
+            kmf.fit(durations[mask], event_observed=observed[mask])
+            sf = kmf.survival_function_
+            for t, value in zip(sf.index, sf.iloc[:, 0]):
+                self.assertAlmostEqual(km.predict(t), value)
+            self.assertEqual(km.median_, kmf.median_)
+
+    def test_median_at_exactly_one_half(self):
+        """
+        Like lifelines, the median is the first day the curve gets down to one half, not below it.
+        """
+        km = fit_groups([0, 0], [5, 10], [True, True])[0]
+        self.assertEqual(km.median_, 5.0)
+        # A curve that ends at exactly one half has a median; one that ends above it doesn't
+        km = fit_groups([0, 0], [5, 10], [True, False])[0]
+        self.assertEqual(km.median_, 5.0)
+        km = fit_groups([0, 0, 0], [5, 10, 10], [True, False, False])[0]
+        self.assertEqual(km.median_, np.inf)
+
+
+class GeoJSONTest(TestCase):
+
+    def test_matches_model_features(self):
+        """
+        Features streamed from values_list rows should be the same as the model builds.
+        """
+        c = Complaint(csr=12345, lon=-118.25, lat=34.05, full_address='200 N Spring St',
+            date_received=date(2013, 2, 1), date_closed=date(2014, 7, 9),
+            csr_problem_type='Noise', csr_priority='3')
+        row = (c.lon, c.lat, c.full_address, c.csr, c.date_received, c.date_closed,
+            c.csr_problem_type, c.csr_priority)
+        self.assertEqual(row_to_feature(row), c.as_geojson_dict())
+        c.date_closed = None
+        row = row[:5] + (None,) + row[6:]
+        self.assertEqual(row_to_feature(row), c.as_geojson_dict())
+
+    def test_compact_round_trip(self):
+        """
+        The compact format should decode to the same features as GeoJSON,
+        give or take the rounding of the coordinates.
+        """
+        rows = [
+            (-118.25, 34.05, '200 N Spring St', 1, date(2013, 2, 1), None, 'Noise', '3'),
+            (-118.4912, 34.0195, '1685 Main St', 2, date(2012, 12, 31), date(2014, 1, 2), 'Vacant lot', '2'),
+            (-118.25001, 34.05002, '201 N Spring St', 3, date(2013, 2, 3), None, 'Noise', None),
+        ]
+        expected = dict((r[3], row_to_feature(r)) for r in rows)
+        for feature in decode_compact(encode_compact(rows)):
+            match = expected.pop(feature['properties']['csr'])
+            self.assertEqual(feature['properties'], match['properties'])
+            for a, b in zip(feature['geometry']['coordinates'], match['geometry']['coordinates']):
+                self.assertAlmostEqual(a, b, places=5)
+        self.assertEqual(expected, {})
+
+
+class SpatialIndexTest(TestCase):
+
+    def test_matches_brute_force(self):
+        """
+        Box and radius queries on the grid should find exactly what checking every point finds.
+        """
+        random = np.random.RandomState(0)
+        lon = random.uniform(-118.7, -118.1, size=2000)
+        lat = random.uniform(33.7, 34.35, size=2000)
+        rows = [(x, y, i) for i, (x, y) in enumerate(zip(lon, lat))]
+        index = SpatialIndex(rows, [i % 2 == 0 for i in range(2000)])
+
+        found = sorted(r[2] for r in index.bbox(-118.4, 33.9, -118.2, 34.1))
+        expected = [i for i in range(2000) if -118.4 <= lon[i] <= -118.2 and 33.9 <= lat[i] <= 34.1]
+        self.assertEqual(found, expected)
+
+        found = [r[2] for r in index.near(34.05, -118.25, 3000, is_closed=True)]
+        distances = haversine(34.05, -118.25, lat, lon)
+        expected = [i for i in np.argsort(distances, kind='mergesort') if distances[i] <= 3000 and i % 2 == 0]
+        self.assertEqual(found, expected)
+        self.assertEqual(index.bbox(-100, 40, -99, 41), [])
+
+
+class RegionsTest(TestCase):
+
+    def test_point_in_polygon(self):
+        """
+        Both ways of testing points against a polygon should agree, holes included,
+        and the first polygon a point falls in should win.
+        """
+        square = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+        hole = [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]
+        layer = regions.PolygonLayer('apc_assigned', {'features': [
+            {'properties': {'APC': 'Harbor'}, 'geometry': {'type': 'Polygon', 'coordinates': [square, hole]}},
+            {'properties': {'APC': 'Central'}, 'geometry': {'type': 'MultiPolygon', 'coordinates': [
+                [[[0, 0], [20, 0], [20, 20], [0, 20]]],
+            ]}},
+        ]}, 'APC')
+        x = [1, 5, 5, 15, 25, 9.99, 0.01]
+        y = [1, 5, 2, 15, 25, 9.99, 5]
+        self.assertEqual(layer.classify(x, y), ['Harbor', 'Central', 'Harbor', 'Central', None, 'Harbor', 'Harbor'])
+
+        random = np.random.RandomState(0)
+        x, y = random.uniform(-1, 11, size=5000), random.uniform(-1, 11, size=5000)
+        polygon = layer.polygons[0]
+        broadcast = polygon.contains(x, y)
+        limit = regions.BROADCAST_LIMIT
+        regions.BROADCAST_LIMIT = 0
+        try:
+            self.assertTrue((polygon.contains(x, y) == broadcast).all())
+        finally:
+            regions.BROADCAST_LIMIT = limit
+        expected = (x > 0) & (x < 10) & (y > 0) & (y < 10) & ~((x > 4) & (x < 6) & (y > 4) & (y < 6))
+        self.assertTrue((broadcast == expected).all())
+
+    def test_assign_regions(self):
+        """
+        A complaint counts toward the CSV's APC when it's one we know and the one
+        from its location otherwise, and the CSV's own value is never changed.
+        """
+        layer = regions.PolygonLayer('apc_assigned', {'features': [
+            {'properties': {'APC': 'Harbor'}, 'geometry': {'type': 'Polygon', 'coordinates': [
+                [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+            ]}},
+        ]}, 'APC')
+        complaints = [
+            Complaint(csr=1, area_planning_commission='Central', lat=5, lon=5),
+            Complaint(csr=2, area_planning_commission='', lat=5, lon=5),
+            Complaint(csr=3, area_planning_commission='Unknown', lat=5, lon=5),
+            Complaint(csr=4, area_planning_commission=None, lat=50, lon=50),
+            Complaint(csr=5, area_planning_commission=None, lat=None, lon=None),
+        ]
+        get_layers = regions.get_layers
+        regions.get_layers = lambda: [layer]
+        try:
+            regions.assign_regions(complaints)
+        finally:
+            regions.get_layers = get_layers
+        self.assertEqual([c.apc_assigned for c in complaints], ['Harbor', 'Harbor', 'Harbor', None, None])
+        self.assertEqual([c.resolved_apc for c in complaints], ['Central', 'Harbor', 'Harbor', None, None])
+        self.assertEqual([c.area_planning_commission for c in complaints], ['Central', '', 'Unknown', None, None])
+
+
+class ComplaintsAPITest(TestCase):
+
+    def test_fields(self):
+        """
+        The API should hand out the fields it's asked for, but never the ones reporters fill in by hand.
+        """
+        Complaint.objects.create(csr=100001, date_received=date(2014, 1, 1), case_flag=False, is_closed=False,
+            notes='Call the landlord first')
+        response = self.client.get('/api/complaints/', {'fields': 'csr,date_received'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['results'], [{'csr': 100001, 'date_received': '2014-01-01'}])
+        for field in MANUAL_FIELDS:
+            response = self.client.get('/api/complaints/', {'fields': 'csr,%s' % field})
+            self.assertEqual(response.status_code, 400)
+            offered = response.content.split('Try any of: ')[1].split(', ')
+            self.assertIn('csr', offered)
+            self.assertNotIn(field, offered)
+
+
+    def test_paging(self):
+        """
+        Following the cursors should visit every complaint once, newest first,
+        including ones that share a date or have none.
+        """
+        dates = [date(2014, 1, 1)] * 5 + [None] * 4 + [date(2013, 6, 1), date(2014, 2, 1)] * 3
+        Complaint.objects.bulk_create([
+            Complaint(csr=i, date_received=d, case_flag=False, is_closed=False) for i, d in enumerate(dates)
+        ])
+        expected = list(Complaint.objects.order_by('-date_received', '-id').values_list('csr', flat=True))
+
+        seen, params = [], {'fields': 'csr', 'limit': 4}
+        while True:
+            data = json.loads(self.client.get('/api/complaints/', params).content)
+            self.assertLessEqual(data['count'], 4)
+            seen.extend(r['csr'] for r in data['results'])
+            if not data['cursor']:
+                break
+            params['cursor'] = data['cursor']
+        self.assertEqual(seen, expected)
+        self.assertEqual(sorted(seen), range(len(dates)))
+
+        self.assertEqual(self.client.get('/api/complaints/', {'cursor': 'nonsense'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/complaints/', {'fields': 'csr,nonsense'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/complaints/', {'limit': 0}).status_code, 400)
+
+def get_histogram_bins():
+    return list(SurvivalHistogram.objects.order_by('region', 'priority', 'days')
+        .values_list('region', 'priority', 'days', 'events', 'censored'))
+
+
+class SurvivalHistogramTest(TestCase):
+
+    def test_apply_changes_matches_rebuild(self):
+        """
+        Adding and removing observations a few at a time should end up with the same bins as counting from scratch.
+        """
+        random = np.random.RandomState(0)
+        observations = [
+            (random.choice(['Harbor', 'Central', None]), str(random.choice(['1', '2', '3'])),
+                int(random.randint(-1, 30)), bool(random.rand() < 0.5))
+            for i in range(300)
+        ]
+        Complaint.objects.bulk_create([
+            Complaint(csr=i, resolved_apc=region, csr_priority=priority, days_since_complaint=days,
+                is_closed=is_closed, case_flag=False)
+            for i, (region, priority, days, is_closed) in enumerate(observations)
+        ])
+        SurvivalHistogram.objects.rebuild()
+        rebuilt = get_histogram_bins()
+
+        # Everything arrives in batches, and some complaints come and go along the way
+        SurvivalHistogram.objects.all().delete()
+        for i in range(0, len(observations), 50):
+            SurvivalHistogram.objects.apply_changes(added=observations[i:i + 50])
+        SurvivalHistogram.objects.apply_changes(removed=observations[:40])
+        SurvivalHistogram.objects.apply_changes(added=observations[:40])
+        self.assertEqual(get_histogram_bins(), rebuilt)
+
+    def test_signals(self):
+        """
+        Saving a single complaint, new or changed, should move it to its new bin.
+        """
+        c = Complaint.objects.create(csr=1, resolved_apc='Harbor', csr_priority='3',
+            days_since_complaint=10, is_closed=False, case_flag=False)
+        self.assertEqual(get_histogram_bins(), [('Harbor', '3', 10, 0, 1)])
+
+        c.is_closed, c.days_since_complaint = True, 12
+        c.save()
+        self.assertEqual(get_histogram_bins(), [('Harbor', '3', 12, 1, 0)])
+
+        c.csr_priority = '1'
+        c.save()
+        Complaint.objects.create(csr=2, resolved_apc=None, csr_priority='2',
+            days_since_complaint=5, is_closed=False, case_flag=False)
+        incremental = get_histogram_bins()
+        self.assertEqual(incremental, [('', '2', 5, 0, 1), ('Harbor', '1', 12, 1, 0)])
+        SurvivalHistogram.objects.rebuild()
+        self.assertEqual(get_histogram_bins(), incremental)
+
+class LoadComplaintsTest(TestCase):
+
+    def build_complaint(self, csr, received, closed=None, as_of=date(2014, 7, 13)):
+        c = Complaint(csr=csr, date_received=received, date_closed=closed, csr_priority='3', case_flag=False,
+            area_planning_commission='Harbor', address_house_number='200', address_house_fraction='',
+            address_street_direction='N', address_street_name='Spring', address_street_suffix='St',
+            address_street_suffix_direction='')
+        derive_complaints([c], as_of=as_of)
+        regions.fill_region(c)
+        return c
+
+    def upsert(self, command, chunk):
+        command.histogram_changes = ([], [])
+        counts = command.upsert_chunk(chunk, command.write_chunk_orm)
+        SurvivalHistogram.objects.apply_changes(*command.histogram_changes)
+        return counts
+
+    def test_incremental_upsert(self):
+        """
+        An incremental load should insert new complaints, rewrite changed ones, bring
+        the derived fields of unchanged ones up to the new as-of date, never touch what
+        reporters filled in and leave everything else alone, keeping the histograms in step.
+        """
+        command = LoadComplaintsCommand()
+        dates = [(1, date(2014, 1, 1), None), (2, date(2014, 3, 1), None), (3, date(2013, 5, 1), date(2013, 6, 1))]
+        chunk = [self.build_complaint(*d) for d in dates]
+        self.assertEqual(self.upsert(command, chunk), (3, 0, 0))
+        Complaint.objects.filter(csr=1).update(notes='Visited in June', inspector='J. Smith', lat_visited=True)
+
+        # Nothing changed, so nothing is written
+        chunk = [self.build_complaint(*d) for d in dates]
+        with self.assertNumQueries(1):
+            self.assertEqual(command.upsert_chunk(chunk, command.write_chunk_orm), (0, 0, 3))
+
+        # The first complaint closed, and a new one arrived
+        dates[0] = (1, date(2014, 1, 1), date(2014, 7, 1))
+        chunk = [self.build_complaint(*d) for d in dates + [(4, date(2014, 7, 1), None)]]
+        self.assertEqual(self.upsert(command, chunk), (1, 1, 2))
+        c = Complaint.objects.get(csr=1)
+        self.assertEqual((c.is_closed, c.days_since_complaint), (True, 181))
+        self.assertEqual((c.notes, c.inspector, c.lat_visited), ('Visited in June', 'J. Smith', True))
+
+        # The same data measured against a later date only moves the open complaints
+        as_of = date(2015, 1, 1)
+        chunk = [self.build_complaint(*(d + (as_of,))) for d in dates + [(4, date(2014, 7, 1), None)]]
+        self.assertEqual(self.upsert(command, chunk), (0, 2, 2))
+        self.assertEqual(
+            list(Complaint.objects.order_by('csr').values_list('csr', 'days_since_complaint', 'more_than_one_year')),
+            [(1, 181, False), (2, 306, False), (3, 31, False), (4, 184, False)],
+        )
+        self.assertEqual(Complaint.objects.get(csr=1).notes, 'Visited in June')
+
+        incremental = get_histogram_bins()
+        SurvivalHistogram.objects.rebuild()
+        self.assertEqual(incremental, get_histogram_bins())
+
+    def test_changed_paths(self):
+        """
+        A file should be loaded again when its contents change,
+        and when it was last measured against a different as-of date than we'd use now.
+        """
+        command = LoadComplaintsCommand()
+        path = '/data/complaints.csv'
+        fingerprints = {path: ('a' * 40, 10)}
+        self.assertEqual(command.get_changed_paths([path], fingerprints), [path])
+
+        command.save_fingerprints([path], fingerprints)
+        self.assertEqual(command.get_changed_paths([path], fingerprints), [])
+        self.assertEqual(command.get_changed_paths([path], {path: ('b' * 40, 10)}), [path])
+
+        SourceFile.objects.update(as_of=date(2000, 1, 1))
+        self.assertEqual(command.get_changed_paths([path], fingerprints), [path])
+
+
+    @skipUnless(connection.vendor == 'postgresql', "--atomic is PostgreSQL only")
+    def test_atomic_swap(self):
+        """
+        The swapped-in staging table should end up with the same primary key,
+        indexes and id sequence as the table it replaced.
+        """
+        command = LoadComplaintsCommand()
+        table = Complaint._meta.db_table
+
+        def get_id_default():
+            cursor = connection.cursor()
+            cursor.execute(
+                "SELECT column_default FROM information_schema.columns WHERE table_name = %s AND column_name = 'id'",
+                [table]
+            )
+            return cursor.fetchone()[0]
+
+        indexes, id_default = sorted(command.get_live_indexes()), get_id_default()
+        self.assertTrue(any(is_primary for name, definition, is_primary in indexes))
+        self.assertTrue(any('(date_received, id)' in definition for name, definition, is_primary in indexes))
+        Complaint.objects.create(csr=1, case_flag=False, is_closed=False)
+
+        command.create_staging_table()
+        command.write_chunk_copy([self.build_complaint(2, date(2014, 1, 1))], table=command.get_staging_table())
+        command.swap_staging_table(command.build_staging_indexes())
+
+        self.assertEqual(sorted(command.get_live_indexes()), indexes)
+        self.assertEqual(get_id_default(), id_default)
+        self.assertEqual(list(Complaint.objects.values_list('csr', flat=True)), [2])
+        # The sequence carried over, so new complaints still get an id
+        c = Complaint.objects.create(csr=3, case_flag=False, is_closed=False)
+        self.assertTrue(c.pk)
+        self.assertEqual(Complaint.objects.count(), 2)
+
+def create_random_complaints(n, seed=0):
+    """
+    Save n complaints with a spread of regions, priorities, statuses and ages.
+    """
+    random = np.random.RandomState(seed)
+    complaints = []
+    for i in range(n):
+        days = int(random.randint(-5, 500))
+        complaints.append(Complaint(csr=i, case_flag=False,
+            resolved_apc=random.choice(['Harbor', 'Central', 'South Valley', None]),
+            csr_priority=str(random.choice(['1', '2', '3'])),
+            csr_problem_type=str(random.choice(['Noise', 'Fence', 'Sign', 'Vacant building'])),
+            date_received=date(2013, 1, 1) + timedelta(days=int(random.randint(0, 500))),
+            is_closed=bool(random.rand() < 0.6), days_since_complaint=days,
+            gt_30_days=days > 30, gt_90_days=days > 90, gt_180_days=days > 180, more_than_one_year=days > 365))
+    Complaint.objects.bulk_create(complaints)
+
+
+class AnalysisTest(TestCase):
+
+    def test_counts_match_queries(self):
+        """
+        The grouped counts should match counting each combination of filters with its own query.
+        """
+        create_random_complaints(300)
+        counts = ComplaintCounts()
+        for region in [None, 'Harbor', 'Central', 'West Los Angeles']:
+            for priority in [None, '1', '2', '3']:
+                for is_closed in (None, False, True):
+                    for age in [None] + list(AGE_FIELDS):
+                        filters = {}
+                        if region:
+                            filters.update(resolved_apc=region, valid_days=True)
+                        if priority:
+                            filters['csr_priority'] = priority
+                        if is_closed is not None:
+                            filters['is_closed'] = is_closed
+                        if age:
+                            filters[age] = True
+                        query = dict(filters)
+                        if query.pop('valid_days', False):
+                            query['days_since_complaint__gte'] = 0
+                        self.assertEqual(counts.count(**filters), Complaint.objects.filter(**query).count(), filters)
+
+    def test_summaries_match_queries(self):
+        """
+        The precomputed summaries and type rollup should match what the analysis pages used to query live.
+        """
+        create_random_complaints(300)
+        top_live = dict((p, get_top_types(n=3, priority=p)) for p in ('', '2'))
+        SurvivalHistogram.objects.rebuild()
+        refresh_summaries()
+        summaries = get_summaries()
+        self.assertEqual(len(summaries), (len(REGION_NAMES) + 1) * 4 * 3)
+
+        valid = Complaint.objects.filter(days_since_complaint__gte=0)
+        dates = sorted(valid.filter(resolved_apc__in=REGION_NAMES).values_list('date_received', flat=True))
+        span_years = (dates[-1] - dates[0]).days / 365.0
+        for (region, priority, is_closed), summary in summaries.items():
+            qs = Complaint.objects.all()
+            if region:
+                qs = qs.filter(resolved_apc=region, days_since_complaint__gte=0)
+            if priority:
+                qs = qs.filter(csr_priority=priority)
+            if is_closed is not None:
+                qs = qs.filter(is_closed=is_closed)
+            self.assertEqual(summary.total, qs.count())
+            for field in AGE_FIELDS:
+                self.assertEqual(getattr(summary, field), qs.filter(**{field: True}).count())
+            if is_closed is None:
+                qs = qs.filter(days_since_complaint__gte=0)
+                median = get_kmf_median(get_kmf_fit(qs)) if qs.exists() else None
+                self.assertEqual(summary.median_wait_kmf, median)
+            if region and not priority and is_closed is None:
+                self.assertAlmostEqual(summary.complaints_per_year, qs.count() / span_years)
+
+        for priority, live in top_live.items():
+            self.assertEqual(get_top_types(n=3, priority=priority), live)
+            for region in REGION_NAMES:
+                qs = Complaint.objects.filter(resolved_apc=region)
+                if priority:
+                    qs = qs.filter(csr_priority=priority)
+                expected = list(qs.values('csr_problem_type').annotate(count=Count('id'))
+                    .order_by('-count', 'csr_problem_type')[:3])
+                self.assertEqual(live[region], expected)
+
+
+class CachingTest(TestCase):
+
+    def setUp(self):
+        # The dev settings use a dummy cache, which never remembers anything
+        self.cache = caching.cache
+        caching.cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='caching-test')
+        caching.cache.clear()
+
+    def tearDown(self):
+        caching.cache = self.cache
+
+    def test_data_version(self):
+        """
+        Cached results should last until the data version moves on.
+        """
+        self.assertEqual(caching.get_or_compute('answer', lambda: 1), 1)
+        self.assertEqual(caching.get_or_compute('answer', lambda: 2), 1)
+        version = caching.get_data_version()
+        self.assertGreater(caching.bump_data_version(), version)
+        self.assertEqual(caching.get_or_compute('answer', lambda: 2), 2)
+        self.assertEqual(caching.get_or_compute('answer', lambda: 3), 2)
+
+    def test_one_recompute(self):
+        """
+        Two workers missing at once should only compute the value once.
+        """
+        calls, started = [], threading.Event()
+
+        def compute():
+            calls.append(1)
+            started.set()
+            time.sleep(0.3)
+            return 'fresh'
+
+        results = []
+        first = threading.Thread(target=lambda: results.append(caching.get_or_compute('slow', compute)))
+        first.start()
+        started.wait(5)
+        results.append(caching.get_or_compute('slow', compute))
+        first.join()
+        self.assertEqual(results, ['fresh', 'fresh'])
+        self.assertEqual(len(calls), 1)
+
+
+class PublishTest(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        publish._manifest.update(directory=None, manifest=None)
+        Complaint.objects.bulk_create([
+            Complaint(csr=i, lon=-118.25 + i / 100.0, lat=34.05, date_received=date(2012, 1, 1),
+                is_closed=i == 2, more_than_one_year=True, case_flag=False, csr_priority='3')
+            for i in range(3)
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        publish._manifest.update(directory=None, manifest=None)
+
+    def get_json(self, response):
+        return json.loads(''.join(response.streaming_content))
+
+    def test_published_and_live(self):
+        """
+        Before anything's published the map's complaints come live from the database.
+        Afterwards the published file is served, with a 304 for clients that already have it.
+        """
+        with override_settings(COMPLAINTS_PUBLISH_ROOT=self.root):
+            response = self.client.get('/api/complaints.json')
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.has_header('ETag'))
+            live = self.get_json(response)
+            self.assertEqual(len(live['features']), 2)
+
+            manifest = publish.publish(version=1)
+            response = self.client.get('/api/complaints.json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.get_json(response), live)
+            etag = response['ETag']
+            self.assertEqual(etag, '"%s"' % manifest['artifacts']['complaints']['etag'])
+
+            # A client with the current copy gets a 304, whichever way it asks
+            self.assertEqual(self.client.get('/api/complaints.json', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(self.client.get('/api/complaints.json', HTTP_IF_NONE_MATCH='"old", %s' % etag).status_code, 304)
+            since = http_date(manifest['published'])
+            self.assertEqual(self.client.get('/api/complaints.json', HTTP_IF_MODIFIED_SINCE=since).status_code, 304)
+            # One with an older copy gets the file, and an ETag beats the date
+            earlier = http_date(manifest['published'] - 60)
+            self.assertEqual(self.client.get('/api/complaints.json', HTTP_IF_MODIFIED_SINCE=earlier).status_code, 200)
+            response = self.client.get('/api/complaints.json', HTTP_IF_NONE_MATCH='"old"', HTTP_IF_MODIFIED_SINCE=since)
+            self.assertEqual(response.status_code, 200)
+
+            # The gzipped copy is a different set of bytes with its own ETag
+            response = self.client.get('/api/complaints.json', HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+            self.assertEqual(response['ETag'], '"%s-gzip"' % manifest['artifacts']['complaints']['etag'])
+            response = self.client.get('/api/complaints.json', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+
+            response = self.client.get('/api/closed_complaints.json', {'format': 'compact'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([f['properties']['csr'] for f in decode_compact(self.get_json(response))], [2])
+
+
+class TilesTest(TestCase):
+
+    def test_tiles_share_edges(self):
+        """
+        Neighboring tiles should meet exactly, and a complaint on a shared edge
+        or corner should be counted on just one of them, zoomed out or in.
+        """
+        for z in (12, 16):
+            lon, lat = -118.25, 34.05
+            px, py = lonlat_to_pixels([lon], [lat], z)
+            x, y = int(px[0] // TILE_SIZE), int(py[0] // TILE_SIZE)
+            west, south, east, north = tile_bounds(z, x, y)
+            self.assertEqual(east, tile_bounds(z, x + 1, y)[0])
+            self.assertEqual(south, tile_bounds(z, x, y + 1)[3])
+
+            # One complaint inside the tile, one on each shared edge and one on the shared corner
+            middle_lon, middle_lat = (west + east) / 2, (south + north) / 2
+            points = [(middle_lon, middle_lat), (east, middle_lat), (middle_lon, south), (east, south)]
+            Complaint.objects.all().delete()
+            Complaint.objects.bulk_create([
+                Complaint(csr=i, lon=p[0], lat=p[1], is_closed=i % 2 == 0, csr_priority='3',
+                    more_than_one_year=True, case_flag=False)
+                for i, p in enumerate(points)
+            ])
+
+            counts = {}
+            for tile in ((x, y), (x + 1, y), (x, y + 1), (x + 1, y + 1)):
+                features = build_tile(z, tile[0], tile[1])['features']
+                if z <= 14:
+                    counts[tile] = sum(f['properties']['count'] for f in features)
+                else:
+                    counts[tile] = len(features)
+            self.assertEqual(counts, {(x, y): 1, (x + 1, y): 1, (x, y + 1): 1, (x + 1, y + 1): 1})
+
+            response = self.client.get('/api/complaints/%s/%s/%s.json' % (z, x + 1, y + 1))
+            self.assertEqual(response.status_code, 200)
+            tile = json.loads(response.content)
+            self.assertEqual(tile['clustered'], z <= 14)
+            if tile['clustered']:
+                self.assertEqual(tile['features'][0]['properties']['closed'], 0)
+                self.assertEqual(tile['features'][0]['properties']['open'], 1)
+            else:
+                self.assertEqual(tile['features'][0]['properties']['csr'], 3)
+
+        self.assertEqual(self.client.get('/api/complaints/2/5/1.json').status_code, 404)
@@ -0,0 +1,143 @@
+"""
+Slippy map tiles of the complaints on the map, as GeoJSON.
+
+Zoomed out, the complaints in each tile are gathered into a grid of clusters,
+with counts of how many are open or closed and of each priority level.
+Zoomed in far enough, a tile lists the individual complaints instead.
+
+Tiles use the same z/x/y numbering as the base map, so the browser only
+asks for what's on screen. The grid is aligned to the tile edges,
+so a cluster never straddles two tiles.
+"""
+import math
+import numpy as np
+from building_and_safety.models import Complaint
+from building_and_safety.geojson import GEOJSON_FIELDS, row_to_feature
+from building_and_safety.compact import encode_compact
+from building_and_safety.survival import PRIORITIES
+
+TILE_SIZE = 256
+
+# Each cluster covers a square this many pixels on a side. It has to divide TILE_SIZE evenly.
+GRID_SIZE = 64
+
+# The furthest in we still cluster. Beyond it tiles hold individual complaints.
+CLUSTER_MAX_ZOOM = 14
+
+# Tiles past this zoom aren't worth asking for
+MAX_ZOOM = 18
+
+
+def get_map_complaints():
+    """
+    The complaints the map shows: those that were open for more than a year
+    and have somewhere to put them.
+    """
+    return Complaint.objects.filter(more_than_one_year=True).exclude(lat=None, lon=None)
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_to_lon(x, z):
+    return x / float(2 ** z) * 360.0 - 180.0
+
+
+def tile_to_lat(y, z):
+    n = math.pi * (1 - 2 * y / float(2 ** z))
+    return math.degrees(math.atan(math.sinh(n)))
+
+
+def tile_bounds(z, x, y):
+    """
+    The (west, south, east, north) edges of a tile in degrees.
+    """
+    return tile_to_lon(x, z), tile_to_lat(y + 1, z), tile_to_lon(x + 1, z), tile_to_lat(y, z)
+
+
+def lonlat_to_pixels(lon, lat, z):
+    """
+    Project arrays of longitudes and latitudes onto the Web Mercator pixel grid at a zoom level.
+    """
+    scale = TILE_SIZE * 2 ** z
+    x = (np.asarray(lon, dtype=float) + 180.0) / 360.0 * scale
+    sin = np.sin(np.radians(np.asarray(lat, dtype=float)))
+    y = (0.5 - np.log((1 + sin) / (1 - sin)) / (4 * math.pi)) * scale
+    return x, y
+
+
+def get_tile_queryset(z, x, y):
+    west, south, east, north = tile_bounds(z, x, y)
+    # Half-open on the right and bottom edges, so no complaint ends up on two tiles
+    return get_map_complaints().filter(lon__gte=west, lon__lt=east, lat__gt=south, lat__lte=north)
+
+
+def cluster_features(rows, z, x, y):
+    """
+    Gather (lon, lat, is_closed, priority) rows into grid clusters, one GeoJSON feature per occupied cell.
+    Each cluster sits at the average position of its complaints.
+    """
+    if not rows:
+        return []
+    lon, lat, is_closed, priority = zip(*rows)
+    lon = np.array(lon, dtype=float)
+    lat = np.array(lat, dtype=float)
+    is_closed = np.array(is_closed, dtype=bool)
+    priority = np.array([p or '' for p in priority])
+
+    px, py = lonlat_to_pixels(lon, lat, z)
+    cells_per_side = TILE_SIZE // GRID_SIZE
+    col = np.clip(((px - x * TILE_SIZE) // GRID_SIZE).astype(np.int64), 0, cells_per_side - 1)
+    row = np.clip(((py - y * TILE_SIZE) // GRID_SIZE).astype(np.int64), 0, cells_per_side - 1)
+    cells, inverse = np.unique(row * cells_per_side + col, return_inverse=True)
+
+    def count(mask=None):
+        weights = None if mask is None else mask.astype(float)
+        return np.bincount(inverse, weights=weights, minlength=len(cells)).astype(np.int64)
+
+    totals = count()
+    closed = count(is_closed)
+    by_priority = dict((p, count(priority == p)) for p in PRIORITIES)
+    mean_lon = np.bincount(inverse, weights=lon, minlength=len(cells)) / totals
+    mean_lat = np.bincount(inverse, weights=lat, minlength=len(cells)) / totals
+
+    features = []
+    for i in range(len(cells)):
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [float(mean_lon[i]), float(mean_lat[i])]
+            },
+            "properties": {
+                "cluster": True,
+                "count": int(totals[i]),
+                "open": int(totals[i] - closed[i]),
+                "closed": int(closed[i]),
+                "priority": dict((p, int(by_priority[p][i])) for p in PRIORITIES),
+            }
+        })
+    return features
+
+
+def build_tile(z, x, y, compact=False):
+    """
+    A FeatureCollection of everything on one tile:
+    clusters up to CLUSTER_MAX_ZOOM and individual complaints past it.
+    Pass compact=True to get the individual complaints in the compact format instead.
+    """
+    queryset = get_tile_queryset(z, x, y).order_by()
+    clustered = z <= CLUSTER_MAX_ZOOM
+    if clustered:
+        rows = list(queryset.values_list('lon', 'lat', 'is_closed', 'csr_priority'))
+        features = cluster_features(rows, z, x, y)
+    elif compact:
+        return encode_compact(queryset.values_list(*GEOJSON_FIELDS))
+    else:
+        features = [row_to_feature(row) for row in queryset.values_list(*GEOJSON_FIELDS)]
+    return {
+        'type': "FeatureCollection",
+        'clustered': clustered,
+        'features': features,
+    }
@@ -1,33 +1,30 @@
 import json
 import csv
+import base64
 import calculate
 import collections
 from datetime import datetime
-from django.db.models import Count
+from django.db.models import BooleanField, DateField, Q
 from django.shortcuts import render
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+from django.core.servers.basehttp import FileWrapper
 from django.shortcuts import get_object_or_404, render
 from django.views.generic import ListView, DetailView, TemplateView
-from building_and_safety.models import Complaint
+from building_and_safety.models import Complaint, REGION_NAMES, MANUAL_FIELDS, get_loaded_as_of_date
+from building_and_safety.analysis import get_summaries, get_top_types, get_complaints_per_year
+from building_and_safety.survival import PRIORITIES, GROUP_BY_FIELDS, FILTER_FIELDS, survival_by_group
+from building_and_safety.caching import get_or_compute, get_stats
+from building_and_safety.geojson import GEOJSON_FIELDS, iter_geojson, iter_queryset_geojson
+from building_and_safety.compact import encode_compact
+from building_and_safety.tiles import get_map_complaints, is_valid_tile, build_tile
+from building_and_safety.spatial import get_spatial_index, DEFAULT_RADIUS, MAX_RADIUS
+from building_and_safety.publish import ENCODINGS, get_artifact
+from building_and_safety.derived import GT_DAYS_FIELDS
 
 from lifelines import KaplanMeierFitter
 
 
-def get_avg_complaints_filed_per_year(region):
-    qs = Complaint.objects.filter(area_planning_commission=region, days_since_complaint__gte=0)\
-            .extra(select={'year':"date_part('year',date_received)"}).values('year')\
-            .annotate(count=Count('id')).order_by('year')
-    total = 0
-
-    for year in qs:
-        total += year['count']
-
-    # now we find the average for the four years
-    # July 13 is the 194th day of the year, so divide by 3 + 194.0 / 365.0,
-    avg = total / 3.5315
-    return avg
-
-
 # Get the average wait time using a Kaplan-Meier Survival analysis estimate
 # Make arrays of the days since complaint, and whether a case is 'closed'
 # this creates the observations, and whether a "death" has been observed
@@ -44,110 +41,93 @@ def get_kmf_median(kmf):
     return kmf.median_
 
 
-def get_counts_by_csr(qs):
-    counts = {}
-    counts["csr1"] = qs.filter(csr_priority="1").count()
-    counts["csr2"] = qs.filter(csr_priority="2").count()
-    counts["csr3"] = qs.filter(csr_priority="3").count()
-    return counts
-
-
 class ComplaintAnalysis(TemplateView):
     # The HTML template we're going to use, found in the /templates directory
     template_name = "complaint_analysis.html"
 
     def get_context_data(self, **kwargs):
-        # Quick notation to access all complaints
-        complaints = Complaint.objects.all()
+        context = super(ComplaintAnalysis, self).get_context_data(**kwargs)
+        context.update(get_or_compute('complaint_analysis', self.get_analysis))
+        context['as_of_date'] = get_loaded_as_of_date()
+        return context
 
-        # Quick means of accessing both open and closed cases
-        open_cases = complaints.filter(is_closed=False)
-        closed_cases = complaints.filter(is_closed=True)
+    def get_analysis(self):
+        # Everything on this page is precomputed each time the complaints are loaded.
+        # A blank region or priority means all of them, and None means open and closed cases together.
+        summaries = get_summaries()
 
-        # Overall complaints not addressed within a year
-        over_one_year = complaints.filter(more_than_one_year=True)
-        open_over_one_year = over_one_year.filter(is_closed=False)
-        closed_over_one_year = over_one_year.filter(is_closed=True)
+        def by_csr(field, region='', is_closed=None):
+            return dict(('csr%s' % p, getattr(summaries[(region, p, is_closed)], field)) for p in PRIORITIES)
 
         # Total counts of cases, all priority levels
-        total_count = complaints.all().count()
-        total_by_csr = get_counts_by_csr(complaints)
+        total_count = summaries[('', '', None)].total
+        total_by_csr = by_csr('total')
 
         # Counts of open cases, all priority levels
-        open_cases_count = open_cases.count()
-        open_by_csr = get_counts_by_csr(open_cases)
+        open_cases_count = summaries[('', '', False)].total
+        open_by_csr = by_csr('total', is_closed=False)
 
         # Counts of cases that have been open fore more than a year, all priority levels
-        open_over_one_year_count = open_over_one_year.count()
-        open_over_one_year_by_csr = get_counts_by_csr(open_over_one_year)
+        open_over_one_year_count = summaries[('', '', False)].more_than_one_year
+        open_over_one_year_by_csr = by_csr('more_than_one_year', is_closed=False)
 
         # Counts of cases that were closed, but have been open for more than a year, all priority levels.
-        closed_over_one_year_count = closed_over_one_year.count()
-        closed_over_one_year_by_csr = get_counts_by_csr(closed_over_one_year)
+        closed_over_one_year_count = summaries[('', '', True)].more_than_one_year
+        closed_over_one_year_by_csr = by_csr('more_than_one_year', is_closed=True)
 
         # A much better means of getting expected wait times is to use a survival analysis function
-        # In this case, we use a Kaplan-Meier estimator from the Python package lifelines
+        # In this case, we use a Kaplan-Meier estimator, which gives the same answers as the Python package lifelines.
         # We repeat this for all complaints, and for each CSR priority levels.
-        all_complaints = Complaint.objects.exclude(days_since_complaint__lt=0)
-        kmf_fit = get_kmf_fit(all_complaints)
-        median_wait_time_kmf = get_kmf_median(kmf_fit)
-
-        csr1 = all_complaints.filter(csr_priority="1")
-        kmf_fit_csr1 = get_kmf_fit(csr1)
-        median_wait_time_csr1_kmf = get_kmf_median(kmf_fit_csr1)
-
-        csr2 = all_complaints.filter(csr_priority="2")
-        kmf_fit_csr2 = get_kmf_fit(csr2)   
-        median_wait_time_csr2_kmf = get_kmf_median(kmf_fit_csr2)
-
-        csr3 = all_complaints.filter(csr_priority="3")
-        kmf_fit_csr3 = get_kmf_fit(csr3)
-        median_wait_time_csr3_kmf = get_kmf_median(kmf_fit_csr3)
+        median_wait_time_kmf = summaries[('', '', None)].median_wait_kmf
+        median_wait_time_csr1_kmf = summaries[('', '1', None)].median_wait_kmf
+        median_wait_time_csr2_kmf = summaries[('', '2', None)].median_wait_kmf
+        median_wait_time_csr3_kmf = summaries[('', '3', None)].median_wait_kmf
 
-        region_names = ['Central','East Los Angeles','Harbor','North Valley','South Los Angeles','South Valley','West Los Angeles']
         regions = {}
 
         # Iterate over each name in our region_names list
-        for region in region_names:
-            # Filter for complaints in each region
-            qs = complaints.filter(area_planning_commission=region, days_since_complaint__gte=0)
+        for region in REGION_NAMES:
+            summary = summaries[(region, '', None)]
             # create a data dictionary for the region
             regions[region] = {}
-            # get a count of how many complaints total are in the queryset
-            regions[region]['total'] = qs.count()
-            regions[region]['avg_complaints_per_year'] = get_avg_complaints_filed_per_year(region)
+            # get a count of how many complaints total are in the region
+            regions[region]['total'] = summary.total
+            regions[region]['avg_complaints_per_year'] = summary.complaints_per_year
 
-            # Separate the complaints into querysets of their respective priority levels 
-            region_csr1 = qs.filter(csr_priority="1")
-            region_csr2 = qs.filter(csr_priority="2")
-            region_csr3 = qs.filter(csr_priority="3")
+            # Get the median value from the KMF fit for all complaints in the area and by each priority level
+            regions[region]['median_wait_kmf'] = summary.median_wait_kmf
+            regions[region]['median_wait_kmf_csr1'] = summaries[(region, '1', None)].median_wait_kmf
+            regions[region]['median_wait_kmf_csr2'] = summaries[(region, '2', None)].median_wait_kmf
+            regions[region]['median_wait_kmf_csr3'] = summaries[(region, '3', None)].median_wait_kmf
 
-            # Find the KMF fit for all complaints in the area and by each priority level
-            regional_kmf_fit = get_kmf_fit(qs)
-            regional_kmf_fit_csr1 = get_kmf_fit(region_csr1)
-            regional_kmf_fit_csr2 = get_kmf_fit(region_csr2)
-            regional_kmf_fit_csr3 = get_kmf_fit(region_csr3)
-
-            # Get the median value from the KMF fit. 
-            regions[region]['median_wait_kmf'] = get_kmf_median(regional_kmf_fit)
-            regions[region]['median_wait_kmf_csr1'] = get_kmf_median(regional_kmf_fit_csr1)
-            regions[region]['median_wait_kmf_csr2'] = get_kmf_median(regional_kmf_fit_csr2)
-            regions[region]['median_wait_kmf_csr3'] = get_kmf_median(regional_kmf_fit_csr3)
-
-            regions[region]['gt_year'] = qs.filter(more_than_one_year=True).count()
+            regions[region]['gt_year'] = summary.more_than_one_year
 
             # Paste response time breakdown here
             # Also grab counts of the number of complaints greater than 30, 90 and 180 days
-            regions[region]['gt_30_days'] = qs.filter(gt_30_days=True).count()
-            regions[region]['gt_90_days'] = qs.filter(gt_90_days=True).count()
-            regions[region]['gt_180_days'] = qs.filter(gt_180_days=True).count()
+            regions[region]['gt_30_days'] = summary.gt_30_days
+            regions[region]['gt_90_days'] = summary.gt_90_days
+            regions[region]['gt_180_days'] = summary.gt_180_days
             # use calculate to find percentages
             regions[region]['per_gt_30_days'] = calculate.percentage(regions[region]['gt_30_days'],regions[region]['total'])
             regions[region]['per_gt_90_days'] = calculate.percentage(regions[region]['gt_90_days'],regions[region]['total'])
             regions[region]['per_gt_180_days'] = calculate.percentage(regions[region]['gt_180_days'],regions[region]['total'])
             regions[region]['per_gt_year'] = calculate.percentage(regions[region]['gt_year'],regions[region]['total'])
-            
-        return locals()
+
+        return {
+            'total_count': total_count,
+            'total_by_csr': total_by_csr,
+            'open_cases_count': open_cases_count,
+            'open_by_csr': open_by_csr,
+            'open_over_one_year_count': open_over_one_year_count,
+            'open_over_one_year_by_csr': open_over_one_year_by_csr,
+            'closed_over_one_year_count': closed_over_one_year_count,
+            'closed_over_one_year_by_csr': closed_over_one_year_by_csr,
+            'median_wait_time_kmf': median_wait_time_kmf,
+            'median_wait_time_csr1_kmf': median_wait_time_csr1_kmf,
+            'median_wait_time_csr2_kmf': median_wait_time_csr2_kmf,
+            'median_wait_time_csr3_kmf': median_wait_time_csr3_kmf,
+            'regions': regions,
+        }
 
 
 class ComplaintTypeBreakdown(TemplateView):
@@ -156,22 +136,50 @@ class ComplaintTypeBreakdown(TemplateView):
     """
     template_name = "complaint_type_breakdown.html"
 
-    def get_context_data(self, **kwargs):
-        region_names = ['Central', 'East Los Angeles', 'Harbor', 'North Valley', 'South Los Angeles', 'South Valley', 'West Los Angeles']
-        regions = {}
+    # The most types we'll list for each region
+    max_top = 100
 
-        for region in region_names:
-            qs = Complaint.objects.filter(area_planning_commission=region, days_since_complaint__gte=0)
-            regions[region] = {}
+    def get_context_data(self, **kwargs):
+        context = super(ComplaintTypeBreakdown, self).get_context_data(**kwargs)
+        filters = self.get_filters()
+        signature = 'complaint_type_breakdown:%s' % json.dumps(
+            [filters['n'], filters['priority'], str(filters['start']), str(filters['end'])]
+        )
+        context['regions'] = get_or_compute(signature, lambda: self.get_regions(**filters))
+        context.update(filters)
+        context['priorities'] = PRIORITIES
+        return context
 
-            # Grab the top 10 types of complaints in each area 
-            # (There are way too many to list all of them) 
-            types = Complaint.objects.filter(area_planning_commission=region)\
-                .values('csr_problem_type').annotate(count=Count('csr_problem_type')).order_by('-count')[0:10]
+    def get_filters(self):
+        """
+        Read ?top=N, ?priority= and the ?start= and ?end= dates (YYYY-MM-DD) from the query string.
+        Anything we can't make sense of falls back to the default.
+        """
+        params = self.request.GET
+        try:
+            n = min(max(int(params.get('top', 10)), 1), self.max_top)
+        except ValueError:
+            n = 10
+        priority = params.get('priority', '')
+        if priority not in PRIORITIES:
+            priority = ''
+        dates = []
+        for name in ('start', 'end'):
+            try:
+                dates.append(datetime.strptime(params.get(name, ''), '%Y-%m-%d').date())
+            except ValueError:
+                dates.append(None)
+        return {'n': n, 'priority': priority, 'start': dates[0], 'end': dates[1]}
+
+    def get_regions(self, n=10, priority='', start=None, end=None):
+        regions = {}
 
-            regions[region]['types'] = types
+        # Grab the top types of complaints in each area, all in one go
+        # (There are way too many to list all of them)
+        for region, types in get_top_types(n, priority, start, end).items():
+            regions[region] = {'types': types}
 
-        return locals()
+        return regions
 
 
 class ComplaintsMap(TemplateView):
@@ -197,41 +205,334 @@ class ComplaintDetail(DetailView):
 
     def get_context_data(self, **kwargs):
         context = super(ComplaintDetail, self).get_context_data(**kwargs)
+        context['as_of_date'] = get_loaded_as_of_date()
         return context
 
 
-def open_complaints_json(request):
+# The payloads the map APIs can send
+PAYLOAD_FORMATS = ('geojson', 'compact')
+
+
+def parse_floats(value, n):
     """
-    Pull all the open complaints that were open for more than a year.
+    Split a comma-separated query string value into exactly n numbers.
     """
-    complaints = Complaint.objects\
-        .filter(is_closed=False, more_than_one_year=True).exclude(lat=None, lon=None)
+    numbers = [float(v) for v in value.split(',')]
+    if len(numbers) != n:
+        raise ValueError("Expected %s numbers" % n)
+    return numbers
 
-    complaints = list(complaints)
-    features = [complaint.as_geojson_dict() for complaint in complaints]
-    objects = {
-        'type': "FeatureCollection",
-        'features': features
-    }
 
-    response = json.dumps(objects)
-    return HttpResponse(response, content_type='text/json')
+def accepts_encoding(request, coding):
+    """
+    Whether the Accept-Encoding header allows a content coding, without a q of zero.
+    """
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        params = [p.strip() for p in part.split(';')]
+        if params[0].lower() != coding:
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def serve_artifact(request, artifact):
+    """
+    Hand out a published file in the best encoding the client accepts,
+    or a 304 Not Modified if it already has the current one.
+    """
+    path, coding = artifact['path'], None
+    for encoding, extension in ENCODINGS:
+        if encoding in artifact['sizes'] and accepts_encoding(request, encoding):
+            path, coding = path + extension, encoding
+            break
+    # Each encoding is a different string of bytes, so each gets its own strong ETag
+    etag = '"%s%s"' % (artifact['etag'], '-%s' % coding if coding else '')
+    last_modified = http_date(artifact['last_modified'])
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        tags = [t.strip() for t in if_none_match.split(',')]
+        not_modified = etag in tags or '*' in tags
+    else:
+        since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        not_modified = since is not None and artifact['last_modified'] <= since
+
+    if not_modified:
+        response = HttpResponseNotModified()
+    else:
+        response = StreamingHttpResponse(FileWrapper(open(path, 'rb')), content_type='text/json')
+        response['Content-Length'] = artifact['sizes'][coding or 'identity']
+        if coding:
+            response['Content-Encoding'] = coding
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    response['Vary'] = 'Accept-Encoding'
+    # Caches may keep it, but have to check back each time, which costs a 304 at most
+    response['Cache-Control'] = 'public, max-age=0, must-revalidate'
+    return response
+
+
+def get_format(request):
+    """
+    The payload format asked for with ?format=, GeoJSON unless it's compact.
+    """
+    format = request.GET.get('format', 'geojson')
+    if format not in PAYLOAD_FORMATS:
+        raise ValueError("Unknown format %s" % format)
+    return format
+
+
+def map_complaints_json(request, is_closed):
+    """
+    Stream the open or closed complaints on the map as GeoJSON,
+    or pass ?format=compact for the smaller columnar format the map decodes itself.
+
+    Without filters, this serves the files published after the last load, if there are any.
+    Pass ?bbox=west,south,east,north, or ?near=lat,lon with an optional &radius= in meters,
+    to get just the complaints in that area from the in-memory spatial index.
+    """
+    try:
+        compact = get_format(request) == 'compact'
+    except ValueError:
+        return HttpResponseBadRequest("format must be one of: %s" % ', '.join(PAYLOAD_FORMATS))
+    try:
+        if 'bbox' in request.GET:
+            west, south, east, north = parse_floats(request.GET['bbox'], 4)
+            rows = get_spatial_index().bbox(west, south, east, north, is_closed=is_closed)
+        elif 'near' in request.GET:
+            lat, lon = parse_floats(request.GET['near'], 2)
+            radius = float(request.GET.get('radius', DEFAULT_RADIUS))
+            if not 0 < radius <= MAX_RADIUS:
+                raise ValueError("radius out of range")
+            rows = get_spatial_index().near(lat, lon, radius, is_closed=is_closed)
+        else:
+            # The whole collection is published as a file each time the data changes
+            name = 'closed_complaints' if is_closed else 'complaints'
+            artifact = get_artifact(name + '.compact' if compact else name)
+            if artifact is not None:
+                return serve_artifact(request, artifact)
+            complaints = get_map_complaints().filter(is_closed=is_closed)
+            if compact:
+                rows = complaints.order_by().values_list(*GEOJSON_FIELDS)
+            else:
+                # Stream the features out as they're read, rather than building every complaint first
+                return StreamingHttpResponse(iter_queryset_geojson(complaints), content_type='text/json')
+    except ValueError:
+        return HttpResponseBadRequest(
+            "Pass bbox=west,south,east,north or near=lat,lon with a radius up to %s meters." % MAX_RADIUS
+        )
+    if compact:
+        return HttpResponse(json.dumps(encode_compact(rows)), content_type='text/json')
+    return StreamingHttpResponse(iter_geojson(rows), content_type='text/json')
+
+
+def open_complaints_json(request):
+    """
+    Pull all the open complaints that were open for more than a year.
+    """
+    return map_complaints_json(request, is_closed=False)
 
 
 def closed_complaints_json(request):
     """
     Pull all the closed complaints that were open for more than a year.
     """
-    complaints = Complaint.objects\
-        .filter(is_closed=True, more_than_one_year=True).exclude(lat=None, lon=None)
+    return map_complaints_json(request, is_closed=True)
+
+
+def complaint_tile_json(request, z, x, y):
+    """
+    One map tile of complaints: clusters when zoomed out, individual complaints when zoomed in.
+    With ?format=compact, individual complaints come in the compact format.
+    Each tile is cached for the current data version.
+    """
+    z, x, y = int(z), int(x), int(y)
+    if not is_valid_tile(z, x, y):
+        raise Http404
+    try:
+        compact = get_format(request) == 'compact'
+    except ValueError:
+        return HttpResponseBadRequest("format must be one of: %s" % ', '.join(PAYLOAD_FORMATS))
+    signature = 'tile:%s/%s/%s%s' % (z, x, y, ':compact' if compact else '')
+    tile = get_or_compute(signature, lambda: build_tile(z, x, y, compact))
+    return HttpResponse(json.dumps(tile), content_type='text/json')
+
+
+def cache_stats_json(request):
+    """
+    Hit, miss and recompute counters for the analysis cache.
+    """
+    return HttpResponse(json.dumps(get_stats()), content_type='text/json')
+
+
+def complaints_per_year_json(request):
+    """
+    How many complaints were filed in each region each year,
+    and the average per year over the span of the data.
+    """
+    data = get_or_compute('complaints_per_year', get_complaints_per_year)
+    data = dict(data, first_received=data['first_received'] and data['first_received'].isoformat(),
+        last_received=data['last_received'] and data['last_received'].isoformat())
+    return HttpResponse(json.dumps(data), content_type='text/json')
+
+
+def parse_filter_value(field, value):
+    """
+    Turn a value from the query string into what the field holds.
+    """
+    if isinstance(Complaint._meta.get_field(field), BooleanField):
+        return value.lower() in ('1', 'true', 'y', 'yes')
+    return value
+
 
-    complaints = list(complaints)
-    features = [complaint.as_geojson_dict() for complaint in complaints]
-    objects = {
-        'type': "FeatureCollection",
-        'features': features
-    }
+def survival_json(request):
+    """
+    Kaplan-Meier medians and survival rates broken down by any of the GROUP_BY_FIELDS.
 
-    response = json.dumps(objects)
+    Example: /api/survival.json?group_by=ladbs_inspection_district&filter=csr_priority:2
+    """
+    group_by = [f for f in request.GET.get('group_by', '').split(',') if f]
+    if not group_by:
+        return HttpResponseBadRequest("Pass at least one group_by field.")
+    for field in group_by:
+        if field not in GROUP_BY_FIELDS:
+            return HttpResponseBadRequest("Can't group by %s. Try one of: %s" % (field, ', '.join(GROUP_BY_FIELDS)))
+
+    filters = {}
+    for f in request.GET.getlist('filter'):
+        field, _, value = f.partition(':')
+        if field not in FILTER_FIELDS:
+            return HttpResponseBadRequest("Can't filter on %s. Try one of: %s" % (field, ', '.join(FILTER_FIELDS)))
+        filters[field] = parse_filter_value(field, value)
+
+    # The same breakdown always costs one computation per data version
+    signature = 'survival:%s' % json.dumps([group_by, sorted(filters.items())])
+    results = get_or_compute(signature, lambda: survival_by_group(group_by, filters))
+    response = json.dumps({'group_by': group_by, 'filters': filters, 'groups': results})
     return HttpResponse(response, content_type='text/json')
 
+
+# Fields the complaints API returns when it isn't asked for particular ones
+API_DEFAULT_FIELDS = ('csr', 'full_address', 'date_received', 'date_closed', 'is_closed',
+    'csr_priority', 'csr_problem_type', 'area_planning_commission', 'resolved_apc', 'days_since_complaint', 'lat', 'lon')
+
+# Every field the API can be asked for. What reporters fill in by hand stays in the admin.
+API_FIELDS = tuple(f.name for f in Complaint._meta.local_fields if f.name not in MANUAL_FIELDS)
+
+API_DEFAULT_LIMIT = 100
+API_MAX_LIMIT = 1000
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def encode_cursor(date_received, pk):
+    """
+    An opaque token for the position of the last complaint on a page.
+    """
+    position = [date_received and date_received.isoformat(), pk]
+    return base64.urlsafe_b64encode(json.dumps(position))
+
+
+def decode_cursor(cursor):
+    try:
+        date_received, pk = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return date_received and parse_date(date_received), int(pk)
+    except (TypeError, ValueError):
+        raise ValueError("Bad cursor")
+
+
+def filter_complaints(queryset, params):
+    """
+    Narrow the complaints down by the API's query string filters.
+    Raises ValueError when one doesn't make sense.
+    """
+    if 'is_closed' in params:
+        queryset = queryset.filter(is_closed=parse_filter_value('is_closed', params['is_closed']))
+    if 'older_than' in params:
+        fields = dict((str(n), name) for name, n in GT_DAYS_FIELDS)
+        if params['older_than'] not in fields:
+            raise ValueError("older_than must be one of %s" % ', '.join(sorted(fields, key=int)))
+        queryset = queryset.filter(**{fields[params['older_than']]: True})
+    if 'priority' in params:
+        if params['priority'] not in PRIORITIES:
+            raise ValueError("priority must be one of %s" % ', '.join(PRIORITIES))
+        queryset = queryset.filter(csr_priority=params['priority'])
+    if 'region' in params:
+        if params['region'] not in REGION_NAMES:
+            raise ValueError("region must be one of %s" % ', '.join(REGION_NAMES))
+        queryset = queryset.filter(resolved_apc=params['region'])
+    if 'start' in params:
+        queryset = queryset.filter(date_received__gte=parse_date(params['start']))
+    if 'end' in params:
+        queryset = queryset.filter(date_received__lte=parse_date(params['end']))
+    if 'bbox' in params:
+        west, south, east, north = parse_floats(params['bbox'], 4)
+        queryset = queryset.filter(lon__gte=west, lon__lte=east, lat__gte=south, lat__lte=north)
+    return queryset
+
+
+def complaints_api(request):
+    """
+    A page of complaints, newest first, as JSON.
+
+    Filter with is_closed, older_than (30, 90, 180 or 365 days), priority, region,
+    start and end dates (YYYY-MM-DD) and bbox=west,south,east,north.
+    Pick the fields you want with fields=csr,lat,lon and only those columns are read.
+    Each page has a cursor for the next one, so deep pages cost the same as the first.
+
+    Example: /api/complaints/?region=Harbor&older_than=365&fields=csr,date_received&limit=50
+    """
+    params = request.GET
+    try:
+        fields = [f for f in params.get('fields', '').split(',') if f] or list(API_DEFAULT_FIELDS)
+        for field in fields:
+            if field not in API_FIELDS:
+                raise ValueError("Can't return %s. Try any of: %s" % (field, ', '.join(API_FIELDS)))
+        limit = int(params.get('limit', API_DEFAULT_LIMIT))
+        if not 0 < limit <= API_MAX_LIMIT:
+            raise ValueError("limit must be between 1 and %s" % API_MAX_LIMIT)
+        queryset = filter_complaints(Complaint.objects.all(), params)
+        if 'cursor' in params:
+            date_received, pk = decode_cursor(params['cursor'])
+            if date_received is None:
+                # Postgres sorts complaints without a date ahead of the rest when going newest first
+                queryset = queryset.filter(Q(date_received=None, id__lt=pk) | Q(date_received__isnull=False))
+            else:
+                # A row comparison, so Postgres can pick up where the last page left off in the index
+                queryset = queryset.extra(where=['("date_received", "id") < (%s, %s)'], params=[date_received, pk])
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    # Fetch one extra row to find out whether there's another page
+    columns = list(fields) + [f for f in ('id', 'date_received') if f not in fields]
+    rows = list(queryset.order_by('-date_received', '-id').values(*columns)[:limit + 1])
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+
+    date_fields = [f for f in fields if isinstance(Complaint._meta.get_field(f), DateField)]
+    results = []
+    for row in rows:
+        result = dict((f, row[f]) for f in fields)
+        for f in date_fields:
+            result[f] = result[f] and result[f].isoformat()
+        results.append(result)
+
+    cursor = None
+    if has_next:
+        cursor = encode_cursor(rows[-1]['date_received'], rows[-1]['id'])
+    next_url = None
+    if cursor:
+        query = request.GET.copy()
+        query['cursor'] = cursor
+        next_url = '%s?%s' % (request.path, query.urlencode())
+    response = json.dumps({'count': len(results), 'next': next_url, 'cursor': cursor, 'results': results})
+    return HttpResponse(response, content_type='text/json')
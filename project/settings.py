@@ -1,4 +1,5 @@
 import os
+from datetime import date
 from django.core.exceptions import SuspiciousOperation
 
 SECRET_KEY = "oxsha^)nxr80^^ti*-u-_=8ah19@8x-qqe)qhd5wd8)f402b+2"
@@ -107,6 +108,25 @@ INSTALLED_APPS = (
     'building_and_safety',
 )
 
+# The day open building and safety complaints are measured against,
+# usually when the data was pulled. Set it to None to always use today.
+COMPLAINTS_AS_OF_DATE = date(2014, 7, 13)
+
+# Polygon layers each complaint's location is checked against as it's loaded.
+# Each fills a Complaint field: with the named property of the polygon the complaint
+# falls in, or just whether it falls in one. Layers without a file are skipped.
+COMPLAINTS_POLYGON_LAYERS = (
+    {
+        'field': 'in_la_city',
+        'path': os.path.join(ROOT_DIR, 'templates', 'static', 'json', 'la_city.json'),
+    },
+    {
+        'field': 'apc_assigned',
+        'path': os.path.join(ROOT_DIR, 'building_and_safety', 'data', 'apc.json'),
+        'property': 'APC',
+    },
+)
+
 # Logging
 MUNIN_ROOT = '/var/cache/munin/www/'
 
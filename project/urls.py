@@ -17,6 +17,11 @@ urlpatterns = patterns('',
     url(r'^complaint_type_breakdown/$', ComplaintTypeBreakdown.as_view(), name='complaint_type_breakdown'),
     url(r'^api/complaints.json$', open_complaints_json, name='complaints-json'),
     url(r'^api/closed_complaints.json$', closed_complaints_json, name='closed-complaints-json'),
+    url(r'^api/complaints/$', complaints_api, name='complaints-api'),
+    url(r'^api/complaints/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+).json$', complaint_tile_json, name='complaint-tile-json'),
+    url(r'^api/complaints_per_year.json$', complaints_per_year_json, name='complaints-per-year-json'),
+    url(r'^api/survival.json$', survival_json, name='survival-json'),
+    url(r'^api/cache_stats.json$', cache_stats_json, name='cache-stats-json'),
     url(r'^complaints-map/$', ComplaintsMap.as_view(), name='complaints-map'),
 )
 